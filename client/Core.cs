@@ -144,6 +144,8 @@ namespace ksp_ris
 		private const int ENOENT = 2, EEXIST = 17, EINVAL = 22;
 		public string host = "127.0.0.1";
 		public UInt16 port = 8080;
+		/* Most /result lookups to have outstanding at once */
+		public int maxInFlight = 4;
 		private Uri server { get { return new UriBuilder("http", host, port).Uri; } }
 		private Uri Page(string path)
 		{
@@ -164,6 +166,7 @@ namespace ksp_ris
 		{
 			node.AddValue("host", host);
 			node.AddValue("port", port);
+			node.AddValue("maxInFlight", maxInFlight);
 			if (inGame != null)
 				node.AddValue("game", inGame);
 			if (ourName != null)
@@ -176,6 +179,10 @@ namespace ksp_ris
 				host = node.GetValue("host");
 			if (node.HasValue("port"))
 				UInt16.TryParse(node.GetValue("port"), out port);
+			if (node.HasValue("maxInFlight"))
+				int.TryParse(node.GetValue("maxInFlight"), out maxInFlight);
+			if (maxInFlight < 1)
+				maxInFlight = 1;
 			if (node.HasValue("game"))
 				inGame = node.GetValue("game");
 			if (node.HasValue("player"))
@@ -423,12 +430,9 @@ namespace ksp_ris
 			return client.CancelAsync;
 		}
 
-		public CancelDelegate Resolve(List<RISMilestoneBase> stones, ResultCallback cb)
+		private CancelDelegate ResolveOne(RISMilestoneBase stone, ResultCallback cb)
 		{
 			WebClient client = new WebClient();
-			CancelDelegate cd = () => {};
-			RISMilestoneBase stone = stones[0];
-			stones.RemoveAt(0);
 			Logging.LogFormat("Resolving {0}", stone.name);
 			client.DownloadStringCompleted += (object sender, DownloadStringCompletedEventArgs e) => {
 				bool result = false;
@@ -450,15 +454,63 @@ namespace ksp_ris
 					/* Job failed, but we still have to exit job state */
 					Logging.LogException(exc);
 				}
-				if (result && stones.Count > 0) {
-					cd += Resolve(stones, cb);
-					return;
-				}
 				cb.Invoke(result);
 			};
 			client.DownloadStringAsync(Page("/result", "game={0}&contract={1}", inGame, stone.name));
-			cd += client.CancelAsync;
-			return cd;
+			return client.CancelAsync;
+		}
+
+		public CancelDelegate Resolve(List<RISMilestoneBase> stones, ResultCallback cb)
+		{
+			/* The lookups don't depend on each other, so we have up to maxInFlight
+			 * of them outstanding at once, over as many kept-alive connections.
+			 */
+			ServicePointManager.FindServicePoint(server).ConnectionLimit = maxInFlight;
+			Queue<RISMilestoneBase> queue = new Queue<RISMilestoneBase>(stones);
+			CancelDelegate cd = () => {};
+			int inFlight = 0;
+			bool ok = true;
+			Action next = null;
+			ResultCallback done = (bool result) => {
+				bool last;
+				lock (queue) {
+					inFlight--;
+					ok &= result;
+					last = inFlight == 0 && (!ok || queue.Count == 0);
+				}
+				if (last)
+					cb.Invoke(ok);
+				else
+					next();
+			};
+			next = () => {
+				while (true) {
+					RISMilestoneBase stone;
+					lock (queue) {
+						if (!ok || queue.Count == 0 || inFlight >= maxInFlight)
+							return;
+						stone = queue.Dequeue();
+						inFlight++;
+					}
+					CancelDelegate one = ResolveOne(stone, done);
+					lock (queue)
+						cd += one;
+				}
+			};
+			if (queue.Count == 0) {
+				cb.Invoke(true);
+				return cd;
+			}
+			next();
+			/* Cancels whatever has been started by the time we're called */
+			return () => {
+				CancelDelegate all;
+				lock (queue) {
+					ok = false;
+					all = cd;
+				}
+				all.Invoke();
+			};
 		}
 	}
 
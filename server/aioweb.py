@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+"""The RIS server on asyncio, for Python 3: the same pages as web.py, giving
+the same JSON (see ../protocol), without Twisted or nevow.
+
+The human-readable pages are only the data, pretty-printed; web.py has the
+real ones.  There is no sharding (-j); each server is a single process.
+"""
+import asyncio
+import html
+import pprint
+import signal
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import ris
+import common
+from common import EPERM, ENOENT, Failed, ActionFailed, dumps
+
+# Seconds to wait for a request on a kept-alive connection
+idle_timeout = 300
+
+class Flusher(common.Flusher):
+    """common.Flusher on the running loop, writing in <executor>; its waiters
+    are Futures."""
+    def __init__(self, delay=0.005, limit=100):
+        common.Flusher.__init__(self, delay, limit)
+        self.executor = None
+    def waiter(self):
+        return asyncio.get_running_loop().create_future()
+    def fire(self, f, error=None):
+        if f.done():
+            # Cancelled: its request has gone
+            return
+        if error is None:
+            f.set_result(None)
+        else:
+            f.set_exception(error)
+    def later(self, delay, fn):
+        return asyncio.get_running_loop().call_later(delay, fn)
+    def cancel(self, call):
+        call.cancel()
+    def call_in_thread(self, fn, done):
+        w = asyncio.get_running_loop().run_in_executor(self.executor, fn)
+        w.add_done_callback(lambda w: done(asyncio.CancelledError()
+                                           if w.cancelled() else w.exception()))
+    async def drain(self):
+        """Save everything, and wait until it's all been written."""
+        await asyncio.gather(*common.Flusher.drain(self),
+                             return_exceptions=True)
+
+flusher = Flusher()
+common.flusher = flusher
+
+class Request(object):
+    """One HTTP request, and the headers of our response to it."""
+    def __init__(self, method, path, query, headers, ip, writer):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.writer = writer
+        # Like twisted.web's request.args, flattened as web.Page does it
+        self.args = {}
+        for k, v in urllib.parse.parse_qs(query, keep_blank_values=True).items():
+            self.args[k] = v[0] if len(v) == 1 else v
+        self.ip = ip
+        self.local = ip == '127.0.0.1'
+        self.args['_local'] = self.local
+        self.code = 200
+        self.out = {}
+    def getHeader(self, k):
+        return self.headers.get(k.lower())
+    def getClientIP(self):
+        return self.ip
+    def setHeader(self, k, v):
+        self.out[k] = v
+    def redirect(self, url):
+        self.code = 302
+        self.out['location'] = url
+
+REASONS = {200: 'OK', 302: 'Found', 304: 'Not Modified', 400: 'Bad Request',
+           404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+def head(request, length=None):
+    lines = ['HTTP/1.1 %d %s' % (request.code, REASONS.get(request.code, ''))]
+    lines.extend('%s: %s' % kv for kv in request.out.items())
+    if length is None:
+        lines.append('transfer-encoding: chunked')
+    else:
+        lines.append('content-length: %d' % (length,))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+class Page(common.Page):
+    """common.Page, served by serve()."""
+    async def render(self, request):
+        try:
+            self.validate(**request.args)
+        except Failed as e:
+            return self.error(request, e.msg, e.code)
+        except Exception as e:
+            return self.error(request, repr(e))
+        try:
+            if request.args.get('json'):
+                return self.render_json(request)
+            request.setHeader("content-type", "text/html")
+            return (common.PAGE_HEAD + self.html(**request.args) +
+                    common.PAGE_TAIL)
+        except Exception as e:
+            return self.error(request, repr(e))
+    def render_json(self, request):
+        etag, body = self.json_response(request)
+        request.setHeader("etag", etag)
+        if etag in request.headers.get('if-none-match', '').split(', '):
+            request.code = 304
+            return b''
+        return body
+    def html(self, **kwargs):
+        return '<pre>%s</pre>' % (html.escape(pprint.pformat(self.data(**kwargs)),
+                                              quote=False),)
+    def error_html(self, msg):
+        return common.PAGE_HEAD + '<h1>Error</h1><h2>%s</h2>' % (
+                    html.escape(msg, quote=False),) + common.PAGE_TAIL
+    async def when_saved(self, name):
+        """Wait until game <name> has been saved; returns why it failed, if
+        it did."""
+        w = flusher.wait(name)
+        if w is None:
+            return None
+        try:
+            await w
+        except Exception as e:
+            return str(e) or repr(e)
+        return None
+
+class Index(common.Index, Page): pass
+
+class Action(Page):
+    async def render(self, request):
+        rejected = self.admit(request)
+        if rejected is not None:
+            return rejected
+        try:
+            dest = self.act(**request.args)
+        except ActionFailed as e:
+            return self.error(request, e.msg, e.code)
+        except Exception as e:
+            return self.error(request, str(e))
+        name = request.args.get('game') or request.args.get('name')
+        failed = await self.when_saved(name)
+        if failed is not None:
+            return self.error(request, "Failed to save game: %s" % (failed,))
+        if request.args.get('inline'):
+            # Render <dest> as our response, saving the client a redirect
+            path, _, query = dest.partition('?')
+            request.args = dict((k, v[0] if len(v) == 1 else v) for k, v in
+                                urllib.parse.parse_qs(query).items())
+            request.args['_local'] = request.local
+            return await pages[path].render(request)
+        request.redirect(dest)
+        return b''
+
+class NewGame(common.NewGame, Action): pass
+class RmGame(common.RmGame, Action): pass
+class Game(common.Game, Page): pass
+class Player(common.Player, Page): pass
+class Result(common.Result, Page): pass
+class History(common.History, Page): pass
+class Leaderboard(common.Leaderboard, Page): pass
+class Lock(common.Lock, Action): pass
+class Join(common.Join, Action): pass
+class Part(common.Part, Action): pass
+class Sync(common.Sync, Action): pass
+class Completed(common.Completed, Action): pass
+
+class Batch(common.Batch, Page):
+    async def render(self, request):
+        rejected = self.admit(request)
+        if rejected is not None:
+            return rejected
+        body = await Page.render(self, request)
+        failed = await self.when_saved(request.args.get('game'))
+        if failed is not None:
+            return self.error(request, "Failed to save game: %s" % (failed,))
+        return body
+
+class Events(common.Events, Page):
+    async def render(self, request):
+        try:
+            self.validate(**request.args)
+        except Failed as e:
+            return self.error(request, e.msg, e.code)
+        game, since = self.start(request)
+        if request.args.get('stream'):
+            return await self.stream(request, game, since)
+        if not self.waits(request, game, since):
+            return await Page.render(self, request)
+        # Nothing new yet; woken by the next mutation, if it comes in time
+        woken = asyncio.get_running_loop().create_future()
+        def wake(events):
+            if not woken.done():
+                woken.set_result(events)
+        game.watch(wake)
+        try:
+            events = await asyncio.wait_for(woken, self.timeout)
+        except asyncio.TimeoutError:
+            events = []
+        finally:
+            game.unwatch(wake)
+        return self.woken(request, game, since, events)
+    async def stream(self, request, game, since):
+        # We write the response ourselves, chunked, and the connection is
+        # closed after it
+        queue = asyncio.Queue()
+        writer = request.writer
+        def chunk(text):
+            data = text.encode('utf-8')
+            if data:
+                writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+        start = self.stream_start(request, game, since)
+        writer.write(head(request))
+        chunk(start)
+        game.watch(queue.put_nowait)
+        try:
+            while True:
+                try:
+                    events = await asyncio.wait_for(queue.get(), self.timeout)
+                except asyncio.TimeoutError:
+                    chunk(self.PING)
+                else:
+                    chunk(self.stream_events(events))
+                    if events is None:
+                        writer.write(b'0\r\n\r\n')
+                        break
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            game.unwatch(queue.put_nowait)
+        return None
+
+class Admin(Page):
+    """A page for the server administrator only; see common.Admin."""
+    async def render(self, request):
+        if not request.args.get('_local'):
+            return self.error(request, "You're not the server administrator.",
+                              EPERM)
+        try:
+            return self.text(request, **request.args)
+        except Failed as e:
+            return self.error(request, e.msg, e.code)
+
+class Metrics(common.Metrics, Admin): pass
+class Profile(common.Profile, Admin): pass
+
+class Static(Page):
+    def __init__(self, body, ctype):
+        self.body = body
+        self.ctype = ctype
+    async def render(self, request):
+        request.setHeader("content-type", self.ctype)
+        return self.body
+
+pages = {'/': Index(), '/index.htm': Index(),
+         '/main.css': Static(common.main_css, 'text/css'),
+         '/newgame': NewGame(), '/rmgame': RmGame(), '/game': Game(),
+         '/lock': Lock(), '/join': Join(), '/part': Part(), '/sync': Sync(),
+         '/player': Player(), '/result': Result(), '/history': History(),
+         '/leaderboard': Leaderboard(), '/completed': Completed(),
+         '/batch': Batch(), '/events': Events(), '/metrics': Metrics(),
+         '/profile': Profile()}
+
+async def respond(request):
+    """Our response to <request>: the body, or None if the page has already
+    written it."""
+    if request.method not in ('GET', 'HEAD'):
+        request.code = 405
+        return 'Method not allowed.\n'
+    page = pages.get(request.path)
+    if page is None:
+        request.code = 404
+        request.setHeader("content-type", "text/html")
+        return (common.PAGE_HEAD + '<h1>No Such Resource</h1>' +
+                common.PAGE_TAIL)
+    start = time.time()
+    try:
+        return await page.render(request)
+    except Exception as e:
+        print("Failed to render %s: %r" % (request.path, e))
+        request.code = 500
+        return 'Internal server error.\n'
+    finally:
+        common.request_seconds[page.__class__.__name__].observe(
+                time.time() - start)
+
+async def serve(reader, writer):
+    """Answer the HTTP/1.x requests on one connection, keeping it open for
+    more unless the client says otherwise."""
+    peer = writer.get_extra_info('peername')
+    ip = peer[0] if peer else None
+    try:
+        while True:
+            try:
+                data = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                              idle_timeout)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    asyncio.TimeoutError, ConnectionError):
+                break
+            lines = data.decode('latin-1').split('\r\n')
+            try:
+                method, target, version = lines[0].split(' ')
+            except ValueError:
+                writer.write(b'HTTP/1.1 400 Bad Request\r\n'
+                             b'content-length: 0\r\nconnection: close\r\n\r\n')
+                break
+            headers = {}
+            for line in lines[1:]:
+                k, sep, v = line.partition(':')
+                if sep:
+                    headers[k.strip().lower()] = v.strip()
+            length = int(headers.get('content-length') or 0)
+            if length:
+                await reader.readexactly(length)
+            conn = headers.get('connection', '').lower()
+            if version == 'HTTP/1.1':
+                keep = conn != 'close'
+            else:
+                keep = conn == 'keep-alive'
+            path, _, query = target.partition('?')
+            request = Request(method, urllib.parse.unquote(path), query,
+                              headers, ip, writer)
+            body = await respond(request)
+            if body is None:
+                # streamed; the connection can't be reused
+                break
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            request.setHeader('connection', 'keep-alive' if keep else 'close')
+            writer.write(head(request, len(body)))
+            if method != 'HEAD':
+                writer.write(body)
+            await writer.drain()
+            if not keep:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+def parse_args():
+    x = common.option_parser()
+    opts, args = x.parse_args()
+    if args:
+        x.error("Unexpected positional arguments")
+    return opts
+
+async def run(opts):
+    common.configure(opts)
+    flusher.executor = ThreadPoolExecutor(opts.io_threads)
+    games = common.load_games(opts)
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+    server = await asyncio.start_server(serve, port=opts.port, backlog=1024)
+    async def evict():
+        while True:
+            await asyncio.sleep(60)
+            flusher.evict(games)
+            if common.limiter is not None:
+                common.limiter.prune()
+    evicter = loop.create_task(evict())
+    await stop
+    evicter.cancel()
+    server.close()
+    await flusher.drain()
+    games.write_index()
+
+def main(opts):
+    asyncio.run(run(opts))
+
+if __name__ == '__main__':
+    main(parse_args())
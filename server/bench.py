@@ -0,0 +1,433 @@
+#!/usr/bin/python2
+"""Benchmarks for the RIS server.
+
+Races are synthesised from the real milestones in GameData/RIS/Firsts, so that
+the number and mix of contracts is realistic.  They can be played through the
+ris.Game API directly ('game' mode), or through web.py's HTTP endpoints on a
+local listener, the way the KSP client would ('http' mode).  'aio' mode does
+the same against aioweb.py, run under Python 3.
+"""
+import optparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import json
+import tempfile
+import shutil
+import urllib
+import zlib
+import collections
+
+import ris
+
+# Found before http mode changes directory
+AIOWEB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aioweb.py')
+
+def milestones(path=ris.FIRSTS_DIR):
+    """Returns [(name, tier)] for every milestone defined under <path>."""
+    cat = ris.load_catalogue(path)
+    return zip(cat.names, cat.tiers)
+
+def day_date(days):
+    """The date <days> days after the start of the game."""
+    return ris.Date(1 + days // 365, 1 + days % 365)
+
+def race(players, stones, seed=0):
+    """Generates the (method, args) calls of a whole race.
+
+    Each player advances in turn by up to two months, completing the next few
+    of <stones> along the way (occasionally skipping one), and then syncs."""
+    rng = random.Random(seed)
+    names = ['Player%d' % (i,) for i in range(players)]
+    for n in names:
+        yield ('join', (n,))
+    todo = dict((n, list(stones)) for n in names)
+    days = dict((n, 0) for n in names)
+    while any(todo.values()):
+        n = rng.choice(names)
+        start = days[n]
+        days[n] += rng.randint(1, 60)
+        while todo[n] and rng.random() < 0.5:
+            name, tier = todo[n].pop(rng.randrange(min(3, len(todo[n]))))
+            if rng.random() < 0.1:
+                continue
+            when = day_date(rng.randint(start, days[n]))
+            yield ('complete', (name, n, when, tier))
+        yield ('sync', (n, day_date(days[n])))
+
+def sizeof(obj, seen=None):
+    """Approximate deep size of <obj> in bytes, not counting classes."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, type) or callable(obj):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k, seen) + sizeof(v, seen) for k,v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(i, seen) for i in obj)
+    if hasattr(obj, '__dict__'):
+        size += sizeof(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, slot):
+                size += sizeof(getattr(obj, slot), seen)
+    return size
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+class Stats(object):
+    """Latency samples, by operation name."""
+    def __init__(self):
+        self.samples = {}
+        self.start = time.time()
+        self.elapsed = None
+        self.count = 0
+        # Bytes of response bodies, as sent, and redirects followed
+        self.bytes = 0
+        self.redirects = 0
+    def record(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+    def stop(self):
+        self.elapsed = time.time() - self.start
+        self.count = sum(len(l) for l in self.samples.values())
+    @property
+    def dict(self):
+        rv = {}
+        for name, l in self.samples.items():
+            l = sorted(l)
+            pc = lambda p: l[min(len(l) - 1, int(len(l) * p / 100.0))]
+            rv[name] = {'count': len(l), 'mean': sum(l) / len(l),
+                        'p50': pc(50), 'p90': pc(90), 'p99': pc(99),
+                        'max': l[-1]}
+        return rv
+    def report(self):
+        print "%-10s %8s %10s %10s %10s %10s (us)" % ('', 'calls', 'mean', 'p50',
+                                                    'p90', 'p99')
+        for name, d in sorted(self.dict.items()):
+            print "%-10s %8d %10.1f %10.1f %10.1f %10.1f" % (name, d['count'],
+                    d['mean'] * 1e6, d['p50'] * 1e6, d['p90'] * 1e6,
+                    d['p99'] * 1e6)
+        if self.elapsed:
+            print "%d requests in %.2fs, %.1f requests/sec" % (self.count,
+                    self.elapsed, self.count / self.elapsed)
+        if self.bytes:
+            print "%d response bytes, %.1f per request; %d redirects" % (
+                    self.bytes, float(self.bytes) / self.count, self.redirects)
+
+def io_report(io, requests):
+    """Prints the I/O counted in <io>, a Counter like ris.io_stats."""
+    written = io['journal_bytes'] + io['snapshot_bytes']
+    if io['rows']:
+        print "save(): %d calls, %d commits, %d rows written" % (io['saves'],
+                io['fsyncs'], io['rows'])
+        return dict(io)
+    print "save(): %d calls, %d fsyncs, %d bytes (%d journal, %d snapshot)" % (
+            io['saves'], io['fsyncs'], written, io['journal_bytes'],
+            io['snapshot_bytes'])
+    if requests:
+        print "%.1f bytes written per request" % (float(written) / requests,)
+    return dict(io)
+
+def bench_game(opts, stones, ops):
+    """Plays the race through ris.Game; returns a dict of results."""
+    # Per-method cost of playing the race through, best of opts.repeat
+    best = None
+    for i in range(opts.repeat):
+        g = ris.Game('Bench')
+        stats = Stats()
+        for method, args in ops:
+            stats.record(method, timed(getattr(g, method), *args))
+        stats.stop()
+        if best is None or stats.elapsed < best.elapsed:
+            best = stats
+    # contract_check() on every contract, which is what update() used to do
+    # on each sync
+    contracts = g.contracts.values()
+    for i in range(opts.repeat * 10):
+        for c in contracts:
+            best.record('check', timed(g.contract_check, c))
+    best.report()
+    completions = sum(len(c.date) for c in g.contracts.values())
+    # The event backlog is bounded, so count it separately
+    backlog = set(id(getattr(g, a)) for a in ('events', 'evseqs')
+                  if hasattr(g, a))
+    size = sizeof(g, backlog)
+    print "Game size: %d bytes, %.1f bytes per completion" % (
+            size, float(size) / completions)
+    if hasattr(g, 'events'):
+        print "Event backlog: %d bytes" % (sizeof(g.events) + sizeof(g.evseqs),)
+    return {'latency': best.dict, 'size': size, 'completions': completions}
+
+def spawn_aioweb(opts, tmp):
+    """Starts aioweb.py in <tmp>; returns (process, port) once it's listening."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    # No rate limit or queue cap; see bench_http()
+    argv = [opts.python3, AIOWEB, '-p', str(port), '--rate', '0',
+            '--max-queue', '0', '--firsts', opts.firsts]
+    if opts.store == 'sqlite':
+        argv += ['--db', 'games.db']
+    proc = subprocess.Popen(argv, cwd=tmp)
+    for i in range(100):
+        if proc.poll() is not None:
+            raise Exception("aioweb.py exited with status %d" % (proc.returncode,))
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc, port
+        except socket.error:
+            time.sleep(0.1)
+    proc.terminate()
+    raise Exception("aioweb.py did not start listening")
+
+def aio_io_stats(text):
+    """ris.io_stats, from aioweb.py's /metrics."""
+    io = collections.Counter()
+    for line in text.splitlines():
+        if line.startswith('ris_io_total{'):
+            kind = line.split('"')[1]
+            io[kind] = int(line.rsplit(' ', 1)[1])
+    return io
+
+def bench_http(opts, stones, ops, aio=False):
+    """Plays the race through web.py (or, with <aio>, aioweb.py), over HTTP;
+    returns a Deferred firing with a dict of results.
+
+    Each player's calls are made in order, but the players run concurrently,
+    as separate clients would.  Redirects are followed (unless opts.inline asks
+    for the documents inline), and after each sync the player asks for the
+    /result of every contract it's still waiting on, just as the KSP client
+    does.  Connections are kept alive.
+
+    The server's rate limit and queue cap are off, whatever its defaults, as
+    the race's players all come from one address, at full speed; with them,
+    we'd be timing the server turning us away."""
+    from twisted.internet import reactor, defer
+    from twisted.web import server
+    from twisted.web.client import Agent, HTTPConnectionPool, readBody
+    from twisted.web.http_headers import Headers
+    import web
+    import common
+    tmp = tempfile.mkdtemp(prefix='risbench')
+    os.mkdir(os.path.join(tmp, ris.GAMES_DIR))
+    os.mkdir(os.path.join(tmp, ris.JOURNAL_DIR))
+    if aio:
+        proc, port = spawn_aioweb(opts, tmp)
+        listener = None
+    else:
+        os.chdir(tmp)
+        common.limiter = None
+        common.max_queue = None
+        if opts.store == 'sqlite':
+            common.games = ris.GameTable(store=ris.SQLiteStore('games.db'))
+        else:
+            common.games = ris.GameTable()
+        listener = reactor.listenTCP(0, server.Site(web.root),
+                                     interface='127.0.0.1')
+        port = listener.getHost().port
+    base = 'http://127.0.0.1:%d' % (port,)
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = opts.players
+    agent = Agent(reactor, pool=pool)
+    headers = Headers()
+    if opts.gzip:
+        headers.setRawHeaders('accept-encoding', ['gzip'])
+    stats = Stats()
+
+    @defer.inlineCallbacks
+    def get(path, **kwargs):
+        kwargs['json'] = 1
+        if opts.inline:
+            kwargs['inline'] = 1
+        url = base + path + '?' + urllib.urlencode(kwargs)
+        start = time.time()
+        while True:
+            resp = yield agent.request('GET', url, headers)
+            body = yield readBody(resp)
+            stats.bytes += len(body)
+            if resp.code not in (301, 302, 303):
+                break
+            stats.redirects += 1
+            url = base + resp.headers.getRawHeaders('location')[0]
+        stats.record(path.lstrip('/'), time.time() - start)
+        if resp.headers.getRawHeaders('content-encoding') == ['gzip']:
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        d = json.loads(body)
+        if isinstance(d, dict) and 'err' in d:
+            raise Exception("%s: %s" % (url, d['err']))
+        defer.returnValue(d)
+
+    @defer.inlineCallbacks
+    def player(name, calls):
+        waiting = set()
+        for method, args in calls:
+            if method == 'complete':
+                contract, _, date, tier = args
+                yield get('/completed', game='Bench', player=name,
+                          contract=contract, year=date.year, day=date.day,
+                          tier=tier)
+                waiting.add(contract)
+            elif method == 'sync':
+                _, date = args
+                yield get('/sync', game='Bench', player=name, year=date.year,
+                          day=date.day)
+                for contract in sorted(waiting):
+                    r = yield get('/result', game='Bench', contract=contract)
+                    if r[name]['first'] != ris.Contract.F_UNKNOWN:
+                        waiting.discard(contract)
+        # Finally, as the Refresh button would
+        yield get('/game', name='Bench')
+
+    @defer.inlineCallbacks
+    def play():
+        before = ris.io_stats.copy()
+        try:
+            yield get('/newgame', name='Bench')
+            calls = {}
+            for method, args in ops:
+                if method == 'join':
+                    yield get('/join', game='Bench', name=args[0])
+                    calls[args[0]] = []
+                elif method == 'complete':
+                    calls[args[1]].append((method, args))
+                else:
+                    calls[args[0]].append((method, args))
+            if aio:
+                resp = yield agent.request('GET', base + '/metrics')
+                before = aio_io_stats((yield readBody(resp)))
+            stats.samples.clear()
+            stats.start = time.time()
+            yield defer.gatherResults([player(n, l) for n,l in calls.items()],
+                                      consumeErrors=True)
+            stats.stop()
+            if aio:
+                resp = yield agent.request('GET', base + '/metrics')
+                io = aio_io_stats((yield readBody(resp)))
+            else:
+                io = ris.io_stats.copy()
+        finally:
+            yield pool.closeCachedConnections()
+            if aio:
+                proc.terminate()
+                proc.wait()
+            else:
+                yield listener.stopListening()
+            shutil.rmtree(tmp)
+        io.subtract(before)
+        stats.report()
+        io = io_report(io, stats.count)
+        defer.returnValue({'latency': stats.dict, 'elapsed': stats.elapsed,
+                           'io': io, 'bytes': stats.bytes,
+                           'redirects': stats.redirects})
+    return play()
+
+def run_http(opts, stones, ops, modes):
+    """Runs bench_http() for each of <modes>, under one reactor (which can't
+    be restarted); returns a dict of their results, by mode."""
+    from twisted.internet import reactor, defer
+    results = {}
+    failed = []
+    @defer.inlineCallbacks
+    def run():
+        try:
+            for mode in modes:
+                print "== HTTP (%s)" % ({'http': 'web.py',
+                                         'aio': 'aioweb.py'}[mode],)
+                results[mode] = yield bench_http(opts, stones, ops,
+                                                 aio=mode == 'aio')
+        except Exception as e:
+            failed.append(e)
+        finally:
+            reactor.stop()
+    reactor.callWhenRunning(run)
+    reactor.run()
+    if failed:
+        raise failed[0]
+    return results
+
+def compare(old, new):
+    """Print the change in mean and p99 latency for each operation."""
+    for mode in sorted(new):
+        if mode not in old or not isinstance(new[mode], dict):
+            continue
+        print "Compared with previous run (%s):" % (mode,)
+        for name, d in sorted(new[mode]['latency'].items()):
+            o = old[mode]['latency'].get(name)
+            if o is None:
+                continue
+            print "%-10s mean %+6.1f%%  p99 %+6.1f%%" % (name,
+                    100.0 * (d['mean'] / o['mean'] - 1),
+                    100.0 * (d['p99'] / o['p99'] - 1))
+        if new[mode].get('bytes') and old[mode].get('bytes'):
+            print "%-10s %+6.1f%%" % ('bytes', 100.0 * (float(new[mode]['bytes'])
+                                                     / old[mode]['bytes'] - 1))
+
+def parse_args():
+    x = optparse.OptionParser()
+    x.add_option('-p', '--players', type='int', default=20,
+                 help='Number of players in the simulated race')
+    x.add_option('-s', '--seed', type='int', default=0)
+    x.add_option('-r', '--repeat', type='int', default=3,
+                 help='Run each timing this many times, and report the best')
+    x.add_option('-m', '--mode', action='append',
+                 choices=['game', 'http', 'aio'],
+                 help='What to benchmark (default: game); may be repeated.  '
+                 'aio is http mode against aioweb.py')
+    x.add_option('--store', choices=['file', 'sqlite'], default='file',
+                 help='Where http mode keeps the games (default: file)')
+    x.add_option('--inline', action='store_true',
+                 help='In http mode, have actions return their results inline '
+                 'rather than redirecting')
+    x.add_option('--gzip', action='store_true',
+                 help='In http mode, accept gzipped responses')
+    x.add_option('--python3', default='python3',
+                 help='Interpreter to run aioweb.py with, for aio mode')
+    x.add_option('-o', '--save', help='Write the results to this JSON file')
+    x.add_option('-c', '--compare', help='Compare with results saved earlier')
+    opts, args = x.parse_args()
+    if args:
+        x.error("Unexpected positional arguments")
+    if not opts.mode:
+        opts.mode = ['game']
+    return opts
+
+def main(opts):
+    stones = milestones()
+    ops = list(race(opts.players, stones, seed=opts.seed))
+    print "%d players, %d milestones, %d operations" % (opts.players,
+                                                      len(stones), len(ops))
+    results = {'players': opts.players, 'seed': opts.seed}
+    # http mode changes directory, so resolve these first
+    save = opts.save and os.path.abspath(opts.save)
+    opts.firsts = os.path.abspath(ris.FIRSTS_DIR)
+    old = None
+    if opts.compare:
+        with open(opts.compare, 'r') as f:
+            old = json.load(f)
+    if 'game' in opts.mode:
+        print "== ris.Game"
+        results['game'] = bench_game(opts, stones, ops)
+    modes = [m for m in ('http', 'aio') if m in opts.mode]
+    if modes:
+        results.update(run_http(opts, stones, ops, modes))
+    if 'http' in results and 'aio' in results:
+        print "aioweb.py: %+.1f%% requests/sec compared with web.py" % (
+                100.0 * (results['http']['elapsed'] /
+                         results['aio']['elapsed'] - 1),)
+    if old is not None:
+        compare(old, results)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,1052 @@
+#!/usr/bin/python2
+# Also runs on Python 3, for aioweb.py
+"""What web.py and aioweb.py have in common: the pages' logic, caching,
+admission control, metrics and options; everything but the HTTP server.
+
+The servers' pages subclass these, adding render methods for their own
+request objects, which need args, setHeader(), getHeader() and getClientIP()
+as Twisted's have them.
+"""
+from __future__ import print_function
+
+import collections
+import cProfile
+import hashlib
+import json
+import math
+import optparse
+import os
+import pstats
+import time
+import zlib
+try:
+    from StringIO import StringIO
+    from urllib import quote_plus
+except ImportError:
+    from io import StringIO
+    from urllib.parse import quote_plus
+
+import ris
+
+# We cannot import errno, because the errno values aren't the same on all
+# platforms; we standardise on the Linux values for RIS protocol purposes
+EPERM = 1
+ENOENT = 2
+EAGAIN = 11
+EEXIST = 17
+EINVAL = 22
+ENOTEMPTY = 39
+
+main_css = """
+table { border: 1px solid; }
+th,td { border: 1px solid gray; }
+td.num { text-align: right; }
+"""
+
+PAGE_HEAD = ('<html><head><title>KSP Race Into Space server</title>'
+             '<link href="main.css" rel="stylesheet" /></head><body>')
+PAGE_TAIL = '</body></html>'
+
+# Set up by the server's main(); see configure()
+games = ris.GameTable()
+# The server's Flusher, which saves the games
+flusher = None
+# JSON responses at least this big are gzipped, for clients that accept it;
+# None to never compress them
+gzip_after = 1024
+# Token buckets for the mutating pages, by (client IP, game, player); None
+# to not limit them.  Off unless --rate is given, since the KSP client doesn't
+# yet back off when it's turned away
+limiter = None
+# Turn away changes to a game with this many requests already waiting for it
+# to be saved; None (unless --max-queue is given) for no limit
+max_queue = None
+
+# Page name: Histogram of seconds taken to answer its requests
+request_seconds = collections.defaultdict(ris.Histogram)
+# Page name: number of requests answered with an error
+request_errors = collections.Counter()
+# (page name, 'rate' or 'queue'): number of requests turned away by admit()
+request_rejected = collections.Counter()
+# The admin's cProfile.Profile, while /profile is on
+profiler = None
+
+def dumps(obj):
+    """JSON without the spaces json.dumps() puts after separators."""
+    return json.dumps(obj, separators=(',', ':'))
+
+def accepts_gzip(request):
+    for coding in (request.getHeader('accept-encoding') or '').split(','):
+        coding, _, q = coding.replace(' ', '').lower().partition(';q=')
+        if coding in ('gzip', '*'):
+            try:
+                return float(q or 1) > 0
+            except ValueError:
+                return True
+    return False
+
+class ResponseCache(object):
+    """Serialised responses, keyed on (page, arguments, version).
+
+    Entries for old versions are never looked up again, so they just age out.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = collections.OrderedDict()
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+    def forget(self, name):
+        """Drop the pages of game <name>, which has been removed (or made)."""
+        for key in [k for k in self.entries if len(k) == 4 and
+                    (('game', name) in k[2] or ('name', name) in k[2])]:
+            del self.entries[key]
+
+cache = ResponseCache()
+
+class Flusher(object):
+    """Group commit: games are saved a few milliseconds after they change, so
+    that a burst of mutations costs one write rather than one each.
+
+    The writing is done in a thread pool, from a copy of the game taken by its
+    store's prepare(), so that saving a big game doesn't hold up everyone
+    else's requests.  Each game's writes are done in order.
+
+    Requests that made the changes wait() for the save, so they are still only
+    answered once their changes are on disk.  What they wait on is a
+    'waiter', a Deferred or a Future: each server subclasses this with the
+    glue for its event loop (waiter(), fire(), later(), cancel() and
+    call_in_thread())."""
+    def __init__(self, delay=0.005, limit=100):
+        # Seconds to wait for more mutations before saving
+        self.delay = delay
+        # Save at once if this many mutations are waiting
+        self.limit = limit
+        self.dirty = collections.OrderedDict()
+        # game name: [waiter] for the save of its dirty changes
+        self.waiters = {}
+        self.count = 0
+        self.call = None
+        # game name: [(fn, done)] queued behind the write in progress
+        self.queues = {}
+        # game name: [waiter] to fire when its queue is empty
+        self.drained = {}
+    def waiter(self):
+        """A new waiter, for fire()."""
+        raise NotImplementedError
+    def fire(self, w, error=None):
+        """Fire waiter <w>; with <error>, an exception, if the write failed."""
+        raise NotImplementedError
+    def later(self, delay, fn):
+        """Call fn() in <delay> seconds; returns something to cancel()."""
+        raise NotImplementedError
+    def cancel(self, call):
+        raise NotImplementedError
+    def call_in_thread(self, fn, done):
+        """Call fn() in the thread pool, and then done(exception it raised,
+        or None) back on our own thread."""
+        raise NotImplementedError
+    def save(self, game):
+        """Mark <game> as needing to be saved."""
+        self.dirty[game.name] = game
+        self.count += 1
+        if self.call is None:
+            self.call = self.later(self.delay, self.flush)
+        elif self.count >= self.limit:
+            # Not synchronously: our caller hasn't had a chance to wait() yet
+            self.cancel(self.call)
+            self.call = self.later(0, self.flush)
+    def remove(self, game):
+        """Forget any unsaved changes to <game>, and remove it once its
+        earlier saves have been written."""
+        self.dirty.pop(game.name, None)
+        for w in self.waiters.pop(game.name, []):
+            self.fire(w)
+        self.enqueue(game.name, lambda: game.store.remove(game),
+                     lambda e: self.removed(game.name, e))
+        game.gone()
+    def busy(self):
+        """Names of the games with saves not yet written."""
+        return set(self.dirty) | set(self.queues)
+    def depth(self, name):
+        """How many requests are waiting for game <name> to be saved."""
+        return len(self.waiters.get(name, ())) + len(self.drained.get(name, ()))
+    def wait(self, name):
+        """A waiter that fires once game <name> has been written, or None if
+        there's nothing to wait for."""
+        if name in self.dirty:
+            waiting = self.waiters
+        elif name in self.queues:
+            # Somebody else's save; they'll hear if it failed
+            waiting = self.drained
+        else:
+            return None
+        w = self.waiter()
+        waiting.setdefault(name, []).append(w)
+        return w
+    def drain(self):
+        """Save everything; returns waiters that fire once it's all been
+        written."""
+        self.flush()
+        return [self.wait(n) for n in self.busy()]
+    def submit(self, name, fn):
+        """Call fn() in the thread pool, after earlier writes for game <name>;
+        returns a waiter for it."""
+        w = self.waiter()
+        self.enqueue(name, fn, lambda e: self.fire(w, e))
+        return w
+    def enqueue(self, name, fn, done):
+        """As submit(), but calls done(exception, or None) rather than firing
+        a waiter."""
+        if name in self.queues:
+            self.queues[name].append((fn, done))
+        else:
+            self.queues[name] = []
+            self._run(name, fn, done)
+    def _run(self, name, fn, done):
+        def next(e):
+            if self.queues[name]:
+                self._run(name, *self.queues[name].pop(0))
+            else:
+                del self.queues[name]
+                for w in self.drained.pop(name, []):
+                    self.fire(w)
+            done(e)
+        self.call_in_thread(fn, next)
+    def flush(self):
+        if self.call is not None:
+            self.cancel(self.call)
+        self.call = None
+        dirty, self.dirty = self.dirty, collections.OrderedDict()
+        waiters, self.waiters = self.waiters, {}
+        self.count = 0
+        for name, game in dirty.items():
+            start = time.time()
+            write = game.store.prepare(game)
+            ris.histograms['save_prepare_seconds'].observe(time.time() - start)
+            self.enqueue(name, self.timed(write),
+                         lambda e, name=name, w=waiters.get(name, []):
+                         self.saved(name, w, e))
+    def timed(self, write):
+        def run():
+            start = time.time()
+            write()
+            ris.histograms['save_write_seconds'].observe(time.time() - start)
+        return run
+    def saved(self, name, waiters, e):
+        if e is not None and not waiters:
+            print("Failed to save %s: %s" % (name, e))
+        for w in waiters:
+            self.fire(w, e)
+    def removed(self, name, e):
+        if e is not None:
+            print("Failed to remove %s: %s" % (name, e))
+    def evict(self, games):
+        """As games.evict(), but with each game's compaction written in the
+        thread pool, behind its saves; a game is only unloaded once that is
+        done, and then only if nobody has used it meanwhile."""
+        # Nothing still waiting to be saved should be unloaded
+        names = games.evictable(keep=self.busy())
+        # How many are still being closed, and whether any were unloaded
+        left = [len(names), False]
+        def closed(name, g, used, e):
+            if e is not None:
+                print("Failed to close %s: %s" % (name, e))
+            elif (games.loaded.get(name) is g and games.used.get(name) == used
+                  and name not in self.busy() and not g.watchers):
+                games.unload(name)
+                left[1] = True
+            left[0] -= 1
+            if not left[0] and left[1]:
+                games.write_index()
+        for name in names:
+            g = games.loaded[name]
+            write = g.store.prepare_close(g)
+            if write is None:
+                closed(name, g, games.used.get(name), None)
+            else:
+                used = games.used.get(name)
+                self.enqueue(name, write, lambda e, name=name, g=g, used=used:
+                             closed(name, g, used, e))
+
+def label(v):
+    if not isinstance(v, str):
+        # unicode, on Python 2
+        v = v.encode('utf-8')
+    return '"%s"' % (v.replace('\\', '\\\\').replace('"', '\\"')
+                      .replace('\n', '\\n'),)
+
+class Failed(Exception):
+    def __init__(self, msg, code=None):
+        self.msg = msg
+        self.code = code
+
+class ActionFailed(Failed): pass
+
+class RateLimiter(object):
+    """A token bucket for each key: up to <burst> requests at once, refilled
+    at <rate> a second; for Page.admit()."""
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        # key: (tokens, when they were counted)
+        self.buckets = {}
+    def take(self, key):
+        """Spend a token for <key>; returns 0 if there was one, else the
+        seconds until there will be."""
+        now = self.clock()
+        tokens, then = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - then) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[key] = (tokens - 1, now)
+        return 0
+    def prune(self):
+        """Forget the buckets that have filled up again."""
+        now = self.clock()
+        for key, (tokens, then) in list(self.buckets.items()):
+            if tokens + (now - then) * self.rate >= self.burst:
+                del self.buckets[key]
+
+class Page(object):
+    """Abstract base class for pages with both data and human-readable forms."""
+    def client_ip(self, request):
+        return request.getClientIP()
+    def admit(self, request):
+        """Returns an error, for a client to back off on, if a change should be
+        turned away so as not to hold up everyone else; None to go ahead."""
+        args = request.args
+        player = args.get('player') or (args.get('name') if 'game' in args
+                                        else None)
+        key = tuple(tuple(v) if isinstance(v, list) else v
+                    for v in (self.client_ip(request),
+                              args.get('game') or args.get('name'), player))
+        game = key[1]
+        if max_queue is not None and flusher.depth(game) >= max_queue:
+            return self.reject(request, 'queue', 1,
+                               "Game '%s' is busy; try again later." % (game,))
+        if limiter is None:
+            return None
+        wait = limiter.take(key)
+        if wait:
+            return self.reject(request, 'rate', wait,
+                               "Too many requests; try again in %.1f seconds." %
+                               (wait,))
+        return None
+    def reject(self, request, reason, wait, msg):
+        request_rejected[(self.__class__.__name__, reason)] += 1
+        request.setHeader("retry-after", str(int(math.ceil(wait))))
+        return self.error(request, msg, EAGAIN)
+    def encode(self, request, etag, body):
+        """Returns (etag, body), gzipped if it's big enough and the client
+        will take it.  The gzipped copy is cached, under its own ETag."""
+        if gzip_after is None or len(body) < gzip_after:
+            return etag, body
+        request.setHeader("vary", "accept-encoding")
+        if not accepts_gzip(request):
+            return etag, body
+        etag = etag[:-1] + '-gz"'
+        key = ('gzip', etag)
+        zbody = cache.get(key)
+        if zbody is None:
+            z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            zbody = z.compress(body) + z.flush()
+            cache.put(key, zbody)
+        request.setHeader("content-encoding", "gzip")
+        return etag, zbody
+    def cache_key(self, kind, args, version):
+        return (kind, self.__class__.__name__,
+                tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                             for k,v in args.items())),
+                version)
+    def json_response(self, request):
+        """Sets the headers for the JSON form of the page, and returns its
+        (etag, body) as encode() gives them."""
+        etag, body = self.json(request.args)
+        request.setHeader("content-type", "application/json")
+        # Make clients revalidate, so they can't miss an update
+        request.setHeader("cache-control", "no-cache")
+        return self.encode(request, etag, body)
+    def json(self, args):
+        """Returns (etag, serialised data), from the cache if possible."""
+        version = self.version(**args)
+        if version is not None:
+            key = self.cache_key('json', args, version)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry
+        body = dumps(self.data(**args))
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        entry = ('"%s"' % (hashlib.md5(body).hexdigest(),), body)
+        if version is not None:
+            cache.put(key, entry)
+        return entry
+    def version(self, **kwargs):
+        """Returns something that changes whenever data() would.
+
+        The default, None, means data() is never cached."""
+        return None
+    def validate(self, **kwargs):
+        return
+    def error(self, request, msg, code=None):
+        request_errors[self.__class__.__name__] += 1
+        if request.args.get('json'):
+            request.setHeader("content-type", "application/json")
+            d = {'err': msg}
+            if code is not None:
+                d['code'] = code
+            return dumps(d)
+        request.setHeader("content-type", "text/html")
+        return self.error_html(msg)
+    def query_string(self, **kwargs):
+        return '?' + '&'.join('%s=%s' % (k, quote_plus(v))
+                              for k,v in kwargs.items() if v is not None)
+
+class Index(Page):
+    def version(self, **kwargs):
+        return games.version
+    def summaries(self):
+        return dict((n, games.summary(n)) for n in games)
+    def data(self, **kwargs):
+        return dict((n,{'players': s['players'], 'mindate': s['mindate'].dict})
+                    for n,s in self.summaries().items())
+
+class Game(Page):
+    def validate(self, **kwargs):
+        name = kwargs.get('name')
+        if not name:
+            raise Failed("No name specified.", EINVAL)
+        if name not in games:
+            raise Failed("No such game '%s'." % (name,), ENOENT)
+    def version(self, name, **kwargs):
+        return games[name].version
+    def data(self, name, **kwargs):
+        return games[name].dict
+
+class GamePage(Page):
+    """A page about one game, named by the 'game' input."""
+    def validate(self, **kwargs):
+        name = kwargs.get('game')
+        if not name:
+            raise Failed("No game specified.", EINVAL)
+        if name not in games:
+            raise Failed("No such game '%s'." % (name,), ENOENT)
+    def version(self, game, **kwargs):
+        return games[game].version
+
+class Player(GamePage):
+    def validate(self, **kwargs):
+        GamePage.validate(self, **kwargs)
+        pname = kwargs.get('name')
+        if not pname:
+            raise Failed("No player specified.", EINVAL)
+        if pname not in games[kwargs['game']].players:
+            raise Failed("No such player '%s'." % (pname,), ENOENT)
+    def data(self, game, name, **kwargs):
+        game = games[game]
+        player = game.players[name]
+        return dict((contract.name,{'date': contract.date[player].dict,
+                                    'first': contract.first(player)})
+                    for contract in game.player_contracts(name))
+
+class Result(GamePage):
+    def validate(self, **kwargs):
+        GamePage.validate(self, **kwargs)
+        cname = kwargs.get('contract')
+        if not cname:
+            raise Failed("No contract specified.", EINVAL)
+        if games[kwargs['game']].contract(cname) is None:
+            raise Failed("No such contract '%s'." % (cname,), ENOENT)
+    def data(self, game, contract, **kwargs):
+        return games[game].contract(contract).dict
+
+class History(GamePage):
+    """The standing as of an in-game date; see ris.Game.at()."""
+    def validate(self, **kwargs):
+        GamePage.validate(self, **kwargs)
+        at = kwargs.get('at')
+        if not at:
+            raise Failed("No date specified.", EINVAL)
+        try:
+            ris.Date.parse(at)
+        except ValueError:
+            raise Failed("Bad date '%s'." % (at,), EINVAL)
+    def data(self, game, at, **kwargs):
+        return games[game].at(ris.Date.parse(at))
+
+class Leaderboard(GamePage):
+    """Each player's firsts and funds, from totals kept by ris.Game."""
+    def data(self, game, **kwargs):
+        return games[game].leaderboard
+
+class Events(GamePage):
+    """Change feed; held open until something happens, rather than polled."""
+    # Seconds to hold a long-poll open, and between keepalives on a stream
+    timeout = 30
+    def validate(self, **kwargs):
+        GamePage.validate(self, **kwargs)
+        try:
+            int(kwargs.get('since', 0))
+        except ValueError:
+            raise Failed("Bad 'since' value '%s'." % (kwargs['since'],), EINVAL)
+    # What a stream sends every <timeout> seconds, to keep it open
+    PING = ": ping\n\n"
+    def version(self, **kwargs):
+        return None
+    def data(self, game, since=None, **kwargs):
+        game = games[game]
+        if since is None:
+            since = game.seq
+        return {'seq': game.seq, 'events': game.events_since(int(since))}
+    def start(self, request):
+        """(game, seq since which it wants events) for <request>, which has
+        been validated."""
+        game = games[request.args['game']]
+        return game, int(request.args.get('since', game.seq))
+    def waits(self, request, game, since):
+        """Whether <request> is a long-poll with nothing to answer yet."""
+        return (bool(request.args.get('json')) and
+                game.events_since(since) == [])
+    def woken(self, request, game, since, events):
+        """The answer to a long-poll, once a watcher of <game> has been given
+        <events> (None if the game was removed), or [] on the timeout."""
+        if events is None:
+            return self.error(request, "Game was removed.", ENOENT)
+        request.setHeader("content-type", "application/json")
+        return dumps({'seq': game.seq, 'events': game.events_since(since)})
+    def stream_start(self, request, game, since):
+        """Sets the headers of a Server-Sent Events stream, and returns what it
+        starts with.  The id of each event is its seq, so a browser's
+        EventSource will resume from the right place with Last-Event-ID."""
+        request.setHeader("content-type", "text/event-stream")
+        request.setHeader("cache-control", "no-cache")
+        last = request.getHeader('last-event-id')
+        if last is not None and last.isdigit():
+            since = int(last)
+        backlog = game.events_since(since)
+        if backlog is None:
+            # Client has missed some; it must re-read everything
+            return "event: reset\nid: %d\ndata: %d\n\n" % (game.seq, game.seq)
+        return self.stream_events(backlog)
+    def stream_events(self, events):
+        """What a stream sends when its watcher is given <events>; None means
+        the game was removed, which ends the stream."""
+        if events is None:
+            return "event: gone\ndata: null\n\n"
+        return ''.join("id: %d\ndata: %s\n\n" % (e['seq'], dumps(e))
+                       for e in events)
+
+class Action(Page):
+    """A page that changes a game, and then redirects to (or, with inline=1,
+    renders) the page act() returns."""
+    def act(self, **kwargs):
+        raise NotImplementedError
+
+class NewGame(Action):
+    def act(self, **kwargs):
+        name = kwargs.get('name')
+        if not name:
+            raise ActionFailed("No name specified for new game.", EINVAL)
+        if name in games:
+            raise ActionFailed("There is already a game named '%s'." % (name,),
+                            EEXIST)
+        if '/' in name:
+            raise ActionFailed("Game name may not contain '/'.", EINVAL)
+        if name.startswith('.'):
+            raise ActionFailed("Game name may not start with '.'.", EINVAL)
+        cache.forget(name)
+        games[name] = ris.Game(name)
+        flusher.save(games[name])
+        return '/game' + self.query_string(name=name, json=kwargs.get('json'))
+
+class RmGame(Action):
+    def act(self, **kwargs):
+        name = kwargs.get('game')
+        if not name:
+            raise ActionFailed("No game specified.", EINVAL)
+        if name not in games:
+            raise ActionFailed("There is no game named '%s'." % (name,), ENOENT)
+        game = games[name]
+        if game.locked or not kwargs.get('_local'):
+            raise ActionFailed("Game is locked.", EPERM)
+        if game.players:
+            raise ActionFailed("Game '%s' has %d players." % (name, len(game.players)),
+                               ENOTEMPTY)
+        flusher.remove(game)
+        del games[name]
+        cache.forget(name)
+        return '/' + self.query_string(json=kwargs.get('json'))
+
+class GameAction(Action):
+    """An action on the game named by the 'game' input."""
+    def game(self, kwargs):
+        gname = kwargs.get('game')
+        if not gname:
+            raise ActionFailed("No game name specified.", EINVAL)
+        if gname not in games:
+            raise ActionFailed("No such game '%s'." % (gname,), ENOENT)
+        return games[gname]
+    def player(self, game, kwargs):
+        pname = kwargs.get('player')
+        if not pname:
+            raise ActionFailed("No player name specified.", EINVAL)
+        if pname not in game.players:
+            raise ActionFailed("There is no player named '%s'." % (pname,),
+                               ENOENT)
+        return pname
+    def date(self, kwargs):
+        year = kwargs.get('year')
+        if not year:
+            raise ActionFailed("No year specified.", EINVAL)
+        day = kwargs.get('day')
+        if not day:
+            raise ActionFailed("No day specified.", EINVAL)
+        return year, day
+    def done(self, game, kwargs):
+        flusher.save(game)
+        return '/game' + self.query_string(name=game.name,
+                                           json=kwargs.get('json'))
+
+class Lock(GameAction):
+    def act(self, **kwargs):
+        game = self.game(kwargs)
+        if not kwargs.get('_local'):
+            raise ActionFailed("You're not the server administrator.", EPERM)
+        game.lock()
+        return self.done(game, kwargs)
+
+class Join(GameAction):
+    def act(self, **kwargs):
+        game = self.game(kwargs)
+        if game.locked:
+            raise ActionFailed("Game is locked.", EPERM)
+        name = kwargs.get('name')
+        if not name:
+            raise ActionFailed("No player name specified.", EINVAL)
+        if name in game.players:
+            raise ActionFailed("There is already a player named '%s'." % (name,),
+                            EEXIST)
+        game.join(name)
+        return self.done(game, kwargs)
+
+class Part(GameAction):
+    def act(self, **kwargs):
+        game = self.game(kwargs)
+        if game.locked:
+            raise ActionFailed("Game is locked.", EPERM)
+        name = kwargs.get('name')
+        if not name:
+            raise ActionFailed("No player name specified.", EINVAL)
+        if name not in game.players:
+            raise ActionFailed("There is no player named '%s'." % (name,),
+                               ENOENT)
+        game.part(name)
+        return self.done(game, kwargs)
+
+class Sync(GameAction):
+    def act(self, **kwargs):
+        game = self.game(kwargs)
+        pname = self.player(game, kwargs)
+        year, day = self.date(kwargs)
+        try:
+            kia = int(kwargs.get('kia', 0))
+        except ValueError:
+            raise ActionFailed("Bad 'kia' value '%s'." % (kwargs['kia'],),
+                               EINVAL)
+        try:
+            date = ris.Date.given(year, day)
+        except ValueError:
+            raise ActionFailed("Bad date 'y%sd%s'." % (year, day), EINVAL)
+        game.sync(pname, date, kia=kia)
+        return self.done(game, kwargs)
+
+class Completed(GameAction):
+    def act(self, **kwargs):
+        game = self.game(kwargs)
+        pname = self.player(game, kwargs)
+        year, day = self.date(kwargs)
+        cname = kwargs.get('contract')
+        if not cname:
+            raise ActionFailed("No contract specified.", EINVAL)
+        if not ris.catalogue.knows(cname):
+            raise ActionFailed("Unknown contract '%s'." % (cname,), EINVAL)
+        try:
+            tier = int(kwargs.get('tier', 0))
+        except ValueError:
+            raise ActionFailed("Bad 'tier' value '%s'." % (kwargs['tier'],),
+                               EINVAL)
+        try:
+            date = ris.Date.given(year, day)
+        except ValueError:
+            raise ActionFailed("Bad date 'y%sd%s'." % (year, day), EINVAL)
+        game.complete(cname, pname, date, tier=tier)
+        flusher.save(game)
+        return '/result' + self.query_string(game=game.name, contract=cname,
+                                             json=kwargs.get('json'))
+
+class Batch(Page):
+    """Completions, sync and results in a single request."""
+    def parse(self, kwargs):
+        gname = kwargs.get('game')
+        if not gname:
+            raise Failed("No game name specified.", EINVAL)
+        if gname not in games:
+            raise Failed("No such game '%s'." % (gname,), ENOENT)
+        game = games[gname]
+        pname = kwargs.get('player')
+        if not pname:
+            raise Failed("No player name specified.", EINVAL)
+        if pname not in game.players:
+            raise Failed("There is no player named '%s'." % (pname,), ENOENT)
+        try:
+            date = ris.Date.given(kwargs['year'], kwargs['day'])
+        except KeyError as e:
+            raise Failed("No %s specified." % (e.args[0],), EINVAL)
+        except ValueError:
+            raise Failed("Bad date 'y%sd%s'." % (kwargs['year'], kwargs['day']),
+                         EINVAL)
+        try:
+            kia = int(kwargs.get('kia', 0))
+        except ValueError:
+            raise Failed("Bad 'kia' value '%s'." % (kwargs['kia'],), EINVAL)
+        completions = []
+        for c in self.listarg(kwargs, 'completed'):
+            parts = c.split(',')
+            if len(parts) == 3:
+                parts.append('0')
+            try:
+                cname, year, day, tier = parts
+                completions.append((cname, ris.Date.given(year, day),
+                                    int(tier)))
+            except ValueError:
+                raise Failed("Bad 'completed' value '%s'." % (c,), EINVAL)
+            if not cname:
+                raise Failed("No contract specified.", EINVAL)
+            if not ris.catalogue.knows(cname):
+                raise Failed("Unknown contract '%s'." % (cname,), EINVAL)
+        wanted = [c for c,d,t in completions]
+        wanted.extend(self.listarg(kwargs, 'result'))
+        return game, pname, completions, date, kia, wanted
+    def listarg(self, kwargs, k):
+        v = kwargs.get(k, [])
+        if isinstance(v, list):
+            return v
+        return [v]
+    def validate(self, **kwargs):
+        self.parse(kwargs)
+    def data(self, **kwargs):
+        game, pname, completions, date, kia, wanted = self.parse(kwargs)
+        game.batch(pname, completions, date, kia=kia)
+        flusher.save(game)
+        return {'game': game.dict,
+                'results': dict((c, game.results(c)) for c in wanted)}
+
+class Admin(Page):
+    """A page for the server administrator only, in plain text, from
+    text(request, **args)."""
+    def text(self, request, **kwargs):
+        raise NotImplementedError
+
+class Metrics(Admin):
+    """Counters, timings and per-game gauges, in Prometheus text format."""
+    def text(self, request, **kwargs):
+        request.setHeader("content-type", "text/plain; version=0.0.4")
+        return '\n'.join(self.lines()) + '\n'
+    def histogram(self, name, hist, labels=''):
+        for le, n in hist.cumulative():
+            le = '+Inf' if le == float('inf') else le
+            yield '%s_bucket{%sle="%s"} %d' % (name, labels, le, n)
+        if labels:
+            labels = '{%s}' % (labels.rstrip(','),)
+        yield '%s_sum%s %s' % (name, labels, hist.sum)
+        yield '%s_count%s %d' % (name, labels, hist.count)
+    def lines(self):
+        yield '# TYPE ris_request_seconds histogram'
+        for page, hist in sorted(request_seconds.items()):
+            for l in self.histogram('ris_request_seconds', hist,
+                                    'page=%s,' % (label(page),)):
+                yield l
+        yield '# TYPE ris_request_errors_total counter'
+        for page, n in sorted(request_errors.items()):
+            yield 'ris_request_errors_total{page=%s} %d' % (label(page), n)
+        yield '# TYPE ris_requests_rejected_total counter'
+        for (page, reason), n in sorted(request_rejected.items()):
+            yield 'ris_requests_rejected_total{page=%s,reason=%s} %d' % (
+                    label(page), label(reason), n)
+        for name, hist in sorted(ris.histograms.items()):
+            yield '# TYPE ris_%s histogram' % (name,)
+            for l in self.histogram('ris_' + name, hist):
+                yield l
+        yield '# TYPE ris_io_total counter'
+        for kind, n in sorted(ris.io_stats.items()):
+            yield 'ris_io_total{kind=%s} %d' % (label(kind), n)
+        yield '# TYPE ris_games gauge'
+        yield 'ris_games %d' % (len(games),)
+        yield '# TYPE ris_games_loaded gauge'
+        yield 'ris_games_loaded %d' % (len(games.loaded),)
+        yield '# TYPE ris_saves_pending gauge'
+        yield 'ris_saves_pending %d' % (len(flusher.busy()),)
+        # Only the loaded games; the others would have to be loaded to count
+        gauges = (('players', lambda g: len(g.players)),
+                  ('contracts', lambda g: len(g.contracts)),
+                  ('unresolved', lambda g: len(g.pending)))
+        for name, fn in gauges:
+            yield '# TYPE ris_game_%s gauge' % (name,)
+            for n, g in sorted(games.loaded.items()):
+                yield 'ris_game_%s{game=%s} %d' % (name, label(n), fn(g))
+
+class Profile(Admin):
+    """Turn cProfile on (enable=1) and off (enable=0, which shows the
+    results) for the server administrator."""
+    def text(self, request, enable=None, sort='cumulative', limit='40',
+             **kwargs):
+        global profiler
+        if sort not in ('cumulative', 'time', 'calls', 'name'):
+            raise Failed("Bad 'sort' value '%s'." % (sort,), EINVAL)
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise Failed("Bad 'limit' value '%s'." % (limit,), EINVAL)
+        request.setHeader("content-type", "text/plain")
+        if enable == '1':
+            if profiler is None:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            return "Profiling.\n"
+        if profiler is None:
+            return "Not profiling; use ?enable=1 to start.\n"
+        if enable == '0':
+            profiler.disable()
+        out = StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats(sort)
+        stats.print_stats(limit)
+        if enable == '0':
+            profiler = None
+        return out.getvalue()
+
+def option_parser():
+    """The options both servers take; they add their own, and pass what
+    parse_args() gives them to configure()."""
+    x = optparse.OptionParser()
+    x.add_option('-p', '--port', type='int', help='TCP port number to serve',
+                 default=8080)
+    x.add_option('-f', '--strict', action='store_true')
+    x.add_option('--snapshot-interval', type='int', default=ris.Journal.limit,
+                 help='Journal records to write before taking a new snapshot')
+    x.add_option('--flush-delay', type='float', default=5,
+                 help='Milliseconds to wait for more changes before saving a game')
+    x.add_option('--flush-limit', type='int', default=100,
+                 help='Save at once when this many changes are waiting')
+    x.add_option('--io-threads', type='int', default=4,
+                 help='Threads to write saves with')
+    x.add_option('--gzip-after', type='int', default=gzip_after,
+                 help='Gzip JSON responses of at least this many bytes, for '
+                 'clients that accept it; -1 to never')
+    x.add_option('--rate', type='float', default=0,
+                 help='Changes a second allowed to each client, for each game '
+                 'and player (say, 10); by default, no limit')
+    x.add_option('--burst', type='int', default=20,
+                 help='Changes each client may make at once, within --rate '
+                 '(default: %default)')
+    x.add_option('--max-queue', type='int', default=0,
+                 help='Turn away changes to a game with this many requests '
+                 'waiting for it to be saved (say, 50); by default, no limit')
+    x.add_option('--idle', type='int', default=600,
+                 help='Seconds after which an unused game is unloaded')
+    x.add_option('--max-loaded', type='int',
+                 help='Maximum number of games to keep loaded')
+    x.add_option('--firsts', default=ris.FIRSTS_DIR,
+                 help='Directory of the .cfg files defining the milestones, '
+                 'for their rewards (default: %default)')
+    x.add_option('--db', help='Keep the games in this SQLite database, rather '
+                 'than in games/ (see migrate.py)')
+    return x
+
+def configure(opts):
+    """Set up our state, and the server's flusher, from <opts>."""
+    global gzip_after, limiter, max_queue
+    ris.Journal.limit = opts.snapshot_interval
+    flusher.delay = opts.flush_delay / 1000.0
+    flusher.limit = opts.flush_limit
+    gzip_after = opts.gzip_after if opts.gzip_after >= 0 else None
+    limiter = RateLimiter(opts.rate, opts.burst) if opts.rate > 0 else None
+    max_queue = opts.max_queue or None
+
+def load_games(opts, store=None, shard=None):
+    """A GameTable of the games in <store> (by default, as --db says), with
+    <opts>' settings; also reads the milestones."""
+    global games
+    # Before any games are loaded, as their players' funds come from it
+    try:
+        ris.catalogue = ris.load_catalogue(opts.firsts)
+    except (IOError, OSError) as e:
+        print("Failed to read milestones (accepting any contract, counting "
+              "no funds): %s" % (e,))
+    if store is None:
+        store = ris.SQLiteStore(opts.db) if opts.db else ris.files
+    games = ris.GameTable(idle=opts.idle, maxloaded=opts.max_loaded,
+                          strict=opts.strict, shard=shard, store=store)
+    if store is ris.files and not os.path.isdir(ris.JOURNAL_DIR):
+        try:
+            os.mkdir(ris.JOURNAL_DIR)
+        except OSError:
+            # another worker may have got there first
+            if not os.path.isdir(ris.JOURNAL_DIR):
+                raise
+    # Only loads the games that changed since we last wrote the index
+    games.scan()
+    return games
+
+def test():
+    """A game that was removed, and made again, mustn't be served from the
+    old one's cache entries, even once its seq has caught up.  And clients'
+    dates must be of days 1 to 365, and they can't change a milestone's
+    tier.  And the RateLimiter's buckets must refill at its rate, and the
+    Flusher must write each game's saves in order, and tell their waiters."""
+    global games, flusher
+    class Flusher(object):
+        def save(self, game):
+            pass
+        remove = save
+    def rejected(fn, **kwargs):
+        try:
+            fn(**kwargs)
+        except Failed as e:
+            return e.code == EINVAL
+        return False
+    saved = games, flusher, ris.catalogue
+    games, flusher = ris.GameTable(), Flusher()
+    ris.catalogue = ris.Catalogue([ris.Milestone('C', 10, 0),
+                                   ris.Milestone('D', 0, 0)], closed=True)
+    try:
+        page = Game()
+        args = {'name': 'G3', 'json': '1'}
+        NewGame().act(name='G3')
+        Join().act(game='G3', name='X')
+        Part().act(game='G3', name='X')
+        old = page.json(args)
+        assert json.loads(old[1])['players'] == {}, old
+        RmGame().act(game='G3', _local=True)
+        NewGame().act(name='G3')
+        Join().act(game='G3', name='Y')
+        Join().act(game='G3', name='Z')
+        assert games['G3'].seq == 2
+        new = page.json(args)
+        assert sorted(json.loads(new[1])['players']) == ['Y', 'Z'], new
+        assert new[0] != old[0]
+        for day in ('0', '366'):
+            date = dict(game='G3', player='Y', year='1', day=day)
+            assert rejected(Sync().act, **date), day
+            assert rejected(Completed().act, contract='C', **date), day
+            assert rejected(Batch().validate, **date), day
+            assert rejected(Batch().validate, game='G3', player='Y', year='1',
+                            day='1', completed='C,1,%s' % (day,)), day
+            assert rejected(History().validate, game='G3', at='y01d%03d' %
+                            (int(day),)), day
+        Sync().act(game='G3', player='Y', year='1', day='365')
+        assert games['G3'].players['Y'].date == ris.Date(1, 365)
+        Completed().act(game='G3', player='Z', contract='C', year='1',
+                        day='5', tier='0')
+        Batch().data(game='G3', player='Z', year='1', day='6',
+                     completed='D,1,5,10')
+        assert [games['G3'].contract(c).tier for c in 'CD'] == [10, 0]
+        now = [0.0]
+        buckets = RateLimiter(2.0, 3, clock=lambda: now[0])
+        assert [buckets.take('a') for i in range(4)] == [0, 0, 0, 0.5]
+        assert buckets.take('b') == 0
+        now[0] = 0.5
+        assert buckets.take('a') == 0 and buckets.take('a') == 0.5
+        now[0] = 10
+        buckets.prune()
+        assert not buckets.buckets
+        flushtest()
+    finally:
+        games, flusher, ris.catalogue = saved
+    print("common.py: ok")
+
+def flushtest():
+    class Manual(Flusher):
+        # Its waiters are lists of what they were told, and the writes are
+        # run when the test says
+        def __init__(self):
+            Flusher.__init__(self)
+            self.threads = []
+        def waiter(self):
+            return []
+        def fire(self, w, error=None):
+            w.append(error)
+        def later(self, delay, fn):
+            return fn
+        def cancel(self, call):
+            pass
+        def call_in_thread(self, fn, done):
+            self.threads.append((fn, done))
+        def step(self):
+            fn, done = self.threads.pop(0)
+            try:
+                fn()
+            except Exception as e:
+                return done(e)
+            done(None)
+    class Store(object):
+        def prepare(self, game):
+            seq = game.seq
+            def write():
+                if seq == 2:
+                    raise IOError("disk full")
+                written.append(seq)
+            return write
+    written = []
+    f = Manual()
+    g = ris.Game('F')
+    g.store = Store()
+    g.join('A')
+    f.save(g)
+    first = f.wait('F')
+    f.flush()
+    g.join('B')
+    f.save(g)
+    second = f.wait('F')
+    f.flush()
+    # Behind both writes, which are run one at a time
+    behind = f.wait('F')
+    assert f.depth('F') == 1 and len(f.threads) == 1
+    f.step()
+    assert written == [1] and first == [None] and second == behind == []
+    f.step()
+    assert str(second[0]) == "disk full" and behind == [None]
+    assert f.busy() == set() and f.wait('F') is None
+    # Evicting: each game is unloaded once it's been compacted, unless it's
+    # been used since
+    class Table(ris.GameTable):
+        def write_index(self):
+            indexed.append(sorted(self.summaries))
+    def prepare_close(game):
+        return lambda: written.append(game.name)
+    Store.prepare_close = staticmethod(prepare_close)
+    written, indexed = [], []
+    t = Table(maxloaded=0, store=Store())
+    t['F'] = g
+    t['G'] = ris.Game('G')
+    t.used['G'] = 0
+    f.evict(t)
+    assert sorted(t.loaded) == ['F', 'G'] and f.busy() == set(['F', 'G'])
+    t['G']
+    f.step()
+    assert written == ['F'] and list(t.loaded) == ['G'] and indexed == []
+    f.step()
+    assert list(t.loaded) == ['G'] and indexed == [['F']]
+    assert f.busy() == set()
+
+if __name__ == '__main__':
+    test()
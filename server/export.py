@@ -0,0 +1,155 @@
+#!/usr/bin/python2
+"""Exports the history of every game, one row per completion, and replays it.
+
+Columns are game, player, contract, year, day, first and tier.  Each player
+also gets a row with no contract, whose date is the date that player has
+synced to; without those, a replay couldn't resolve anything.
+
+Replaying feeds each game's rows back through ris.Game, checks the results
+against the exported ones (and against RescanGame, the reference engine), and
+reports how long it took.
+"""
+import optparse
+import sys
+import csv
+import json
+import itertools
+import time
+
+import ris
+
+COLUMNS = ('game', 'player', 'contract', 'year', 'day', 'first', 'tier')
+
+def rows(game):
+    """Yields the export rows of <game>, as dicts."""
+    d = game.save_dict
+    for pname, p in sorted(d['players'].items()):
+        yield {'game': game.name, 'player': pname, 'contract': None,
+               'year': p['date']['year'], 'day': p['date']['day'],
+               'first': None, 'tier': None}
+    for cname, c in sorted(d['contracts'].items()):
+        for pname, r in sorted(c['players'].items()):
+            yield {'game': game.name, 'player': pname, 'contract': cname,
+                   'year': r['date']['year'], 'day': r['date']['day'],
+                   'first': r.get('first', ris.Contract.F_UNKNOWN),
+                   'tier': c['tier']}
+
+def export(store, names):
+    """Yields the rows of each of the games <names>, loading one at a time."""
+    for name in names:
+        try:
+            g = ris.Game.restore(name, store)
+        except Exception as e:
+            print >>sys.stderr, "Failed to load %s (skipping): %r" % (name, e)
+            continue
+        for row in rows(g):
+            yield row
+        if g.journal is not None:
+            g.journal.close()
+
+def write_csv(f, rows):
+    w = csv.writer(f)
+    w.writerow(COLUMNS)
+    for row in rows:
+        w.writerow(['' if row[k] is None else row[k] for k in COLUMNS])
+
+def write_ndjson(f, rows):
+    for row in rows:
+        f.write(json.dumps(row, sort_keys=True) + '\n')
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        for k in ('contract', 'first', 'tier'):
+            if row[k] == '':
+                row[k] = None
+        yield row
+
+def read_ndjson(f):
+    for line in f:
+        yield json.loads(line)
+
+def replay(name, rows, cls=ris.Game):
+    """Rebuild game <name> from its export rows.
+
+    We only have each player's latest date, so every completion is made first,
+    in date order, and then every player syncs."""
+    g = cls(name)
+    players, completions = [], []
+    for row in rows:
+        date = ris.Date(int(row['year']), int(row['day']))
+        if row['contract'] is None:
+            players.append((row['player'], date))
+        else:
+            completions.append((date, row['contract'], row['player'],
+                                int(row['tier'])))
+    for pname, date in players:
+        g.join(pname)
+    start = time.time()
+    for date, cname, pname, tier in sorted(completions):
+        g.complete(cname, pname, date, tier)
+    for pname, date in sorted(players, key=lambda p: p[1]):
+        g.sync(pname, date)
+    return g, time.time() - start
+
+def check(name, rows):
+    """Replay <rows>; returns (results agreeing with the export, results,
+    seconds taken), and complains if the engines disagree."""
+    rows = list(rows)
+    g, elapsed = replay(name, rows)
+    ref, _ = replay(name, rows, ris.RescanGame)
+    if (g.save_dict, g.dict) != (ref.save_dict, ref.dict):
+        print "%s: ris.Game and RescanGame disagree!" % (name,)
+    agree = total = 0
+    for row in rows:
+        if row['contract'] is None:
+            continue
+        total += 1
+        c = g.contract(row['contract'])
+        if c.first(g.players[row['player']]) == row['first']:
+            agree += 1
+    return agree, total, elapsed
+
+def parse_args():
+    x = optparse.OptionParser(usage='%prog [options] [GAME...]')
+    x.add_option('-f', '--format', choices=['csv', 'ndjson'], default='csv')
+    x.add_option('-o', '--output', help='Write the export here (default: stdout)')
+    x.add_option('--db', help='Export from this SQLite database, rather than '
+                 'from games/')
+    x.add_option('-r', '--replay', metavar='FILE',
+                 help='Replay an export, rather than making one')
+    opts, args = x.parse_args()
+    opts.games = args
+    return opts
+
+def main(opts):
+    read, write = {'csv': (read_csv, write_csv),
+                   'ndjson': (read_ndjson, write_ndjson)}[opts.format]
+    if opts.replay:
+        agree = total = 0
+        elapsed = 0.0
+        with open(opts.replay, 'r') as f:
+            for name, grows in itertools.groupby(read(f), lambda r: r['game']):
+                if opts.games and name not in opts.games:
+                    continue
+                a, n, e = check(name, grows)
+                print "%s: %d of %d results as exported, %.1fms" % (name, a, n,
+                                                                  e * 1e3)
+                agree, total, elapsed = agree + a, total + n, elapsed + e
+        print "Total: %d of %d results as exported, %.1fms" % (agree, total,
+                                                             elapsed * 1e3)
+        return
+    if opts.db:
+        store = ris.SQLiteStore(opts.db)
+    else:
+        # Read-only, since the server may still be running
+        store = ris.FileStore(readonly=True)
+    names = opts.games or sorted(store.names())
+    out = open(opts.output, 'wb') if opts.output else sys.stdout
+    try:
+        write(out, export(store, names))
+    finally:
+        if opts.output:
+            out.close()
+
+if __name__ == '__main__':
+    main(parse_args())
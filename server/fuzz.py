@@ -0,0 +1,250 @@
+#!/usr/bin/python2
+"""Randomised checks of ris.Game's resolution rules, and of what they cost.
+
+Each round plays a random interleaving of join, part, sync, complete, batch
+and lock by a handful of players on a handful of contracts, with dates close
+together, so that same-day ties, tier precedence, late completions and players
+leaving mid-race all come up often; restores of the game through a snapshot,
+its journal or SQLite are mixed in too.  The races are ris.generate()'s, as
+ris.difftest() plays.  Every operation is applied both to the engine under
+test (ris.Game, unless -e names another) and to the reference engine,
+ris.RescanGame.  After each one, the two must agree, and the engine must
+satisfy the invariants in check().
+
+A failing round is shrunk, by dropping operations for as long as it still
+fails, and printed so that it can be replayed.  The cost of each operation is
+timed in both engines and reported as bench.py does, so that an optimised
+engine can be checked against the reference for speed as well.
+"""
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import importlib
+
+import ris
+import bench
+
+def valid(g, op):
+    if op[0] == 'join':
+        return op[1] not in g.players
+    if op[0] in ('lock', 'restore'):
+        return True
+    return (op[2] if op[0] == 'complete' else op[1]) in g.players
+
+def resolved(g):
+    return dict((c.name, c) for c in g.contracts.values() if c.results)
+
+def check(g, ref, op, before):
+    """Problems with <g> after <op>, as a list of strings.
+
+    <before> is what state() said before <op> was applied."""
+    problems = []
+    if (g.save_dict, g.dict, g.leaderboard) != (ref.save_dict, ref.dict,
+                                               ref.leaderboard):
+        problems.append("disagrees with the reference")
+    for d in (g.oldmindate, ris.later(g.oldmindate, -3)):
+        if g.at(d) != ref.at(d):
+            problems.append("disagrees with the reference at %s" % (d,))
+    if g.oldmindate < before['oldmindate']:
+        problems.append("oldmindate went back from %s to %s" %
+                        (before['oldmindate'], g.oldmindate))
+    new = [c for n, c in resolved(g).items() if n not in before['resolved']]
+    if new and op[0] not in ('sync', 'batch', 'part'):
+        problems.append("%s resolved by %s" % (sorted(c.name for c in new),
+                                               op[0]))
+    for c in new:
+        # Only once every other player has passed its firstdate
+        if not g.contract_check(c):
+            problems.append("%s resolved while somebody could still beat %s"
+                            % (c.name, c.firstdate))
+    if new:
+        # The leaders are whoever got there first in the last to be resolved
+        last = max(new, key=lambda c: (c.firstdate, -c.tier, c.id))
+        leaders = set(p.name for p in g.players.values() if p.leader)
+        want = set(p.name for p, r in last.results.items()
+                   if r != ris.Contract.F_NOT_FIRST)
+        if leaders != want:
+            problems.append("leaders %s, but %s was resolved last" %
+                            (sorted(leaders), last.name))
+    update_ran = (op[0] in ('sync', 'batch', 'part') and
+                  g.mindate >= g.oldmindate)
+    for c in g.contracts.values():
+        firsts = [p for p in c.date
+                  if c.first(p) in (ris.Contract.F_FIRST,
+                                    ris.Contract.F_WAS_LEADER)]
+        if not c.results:
+            if firsts:
+                problems.append("%s unresolved, but has firsts" % (c.name,))
+            if update_ran and g.contract_check(c):
+                problems.append("%s could have been resolved" % (c.name,))
+            continue
+        # Only the first-date cohort can be first.  (The not_firsts can't
+        # tell us when that was: a reloaded game has late completions in
+        # results, as not_first.)
+        cohort = min([c.date[p] for p in firsts] or [None])
+        for p in firsts:
+            if c.date[p] != cohort:
+                problems.append("%s: %s is %s on %s, after %s" % (
+                        c.name, p.name, c.first(p), c.date[p], cohort))
+    fresh = type(g).from_dict(g.name, g.save_dict)
+    for attr in ('pending', 'ready', 'history', 'by_player'):
+        if getattr(g, attr, None) != getattr(fresh, attr, None):
+            problems.append("%s differs from a rebuilt one" % (attr,))
+    return problems
+
+def state(g):
+    return {'oldmindate': g.oldmindate, 'resolved': set(resolved(g))}
+
+def play(ops, engine, reference, stats=None):
+    """Applies <ops> to new games of both engines, checking each step.
+
+    Returns (index of the failing op, its problems), or None if all was well.
+    Operations that aren't valid for the game as it stands are skipped.  On a
+    restore, the engine's game is reloaded as the op says, and the
+    reference's from its save_dict; these aren't timed.  The files store
+    works in the current directory."""
+    g, ref = engine('Fuzz'), reference('Fuzz')
+    db = ris.SQLiteStore(':memory:')
+    for i, op in enumerate(ops):
+        if not valid(ref, op):
+            continue
+        before = state(g)
+        if op[0] == 'restore':
+            try:
+                g, ref = ris.reload(g, op[1], db), ris.reload(ref, 'json')
+            except Exception as e:
+                return i, ["restore raised %r" % (e,)]
+        else:
+            for game, s in ((g, stats and stats[0]),
+                            (ref, stats and stats[1])):
+                start = time.time()
+                try:
+                    getattr(game, op[0])(*op[1:])
+                except Exception as e:
+                    return i, ["%s raised %r" % (type(game).__name__, e)]
+                if s is not None:
+                    s.record(op[0], time.time() - start)
+        problems = check(g, ref, op, before)
+        if problems:
+            return i, problems
+    return None
+
+def shrink(ops, engine, reference):
+    """A shorter list of operations that still fails, found by dropping ever
+    smaller runs of them."""
+    ops = ops[:play(ops, engine, reference)[0] + 1]
+    chunk = len(ops) // 2
+    while chunk:
+        i = 0
+        while i < len(ops):
+            trial = ops[:i] + ops[i + chunk:]
+            if trial and play(trial, engine, reference) is not None:
+                ops = trial
+            else:
+                i += chunk
+        chunk //= 2
+    return ops
+
+def load_class(path):
+    module, _, name = path.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+def speed_report(stats, reference, budget=None):
+    """Compares mean costs; returns the ops over <budget> times the
+    reference's."""
+    ref = reference.dict
+    over = []
+    print "%-10s %10s %10s %8s (us)" % ('', 'engine', 'reference', 'speedup')
+    for name, d in sorted(stats.dict.items()):
+        r = ref[name]
+        print "%-10s %10.1f %10.1f %7.1fx" % (name, d['mean'] * 1e6,
+                                               r['mean'] * 1e6,
+                                               r['mean'] / d['mean'])
+        if budget is not None and d['mean'] > budget * r['mean']:
+            over.append(name)
+    return over
+
+def parse_args():
+    x = optparse.OptionParser()
+    x.add_option('-r', '--rounds', type='int', default=100)
+    x.add_option('-n', '--steps', type='int', default=300,
+                 help='Operations in each round')
+    x.add_option('-p', '--players', type='int', default=8,
+                 help='Number of player names to draw from')
+    x.add_option('-c', '--contracts', type='int', default=24,
+                 help='Number of contract names to draw from')
+    x.add_option('--spread', type='int', default=10,
+                 help='Most days a sync or completion may be ahead')
+    x.add_option('-s', '--seed', type='int', default=0)
+    x.add_option('-e', '--engine', default='ris.Game',
+                 help='Class to check, as module.Class (default: %default)')
+    x.add_option('--reference', default='ris.RescanGame',
+                 help='Class to check it against (default: %default)')
+    x.add_option('--budget', type='float',
+                 help='Fail if an operation costs, on average, more than '
+                 'this many times what it does in the reference')
+    opts, args = x.parse_args()
+    if args:
+        x.error("Unexpected positional arguments")
+    return opts
+
+def run(opts):
+    engine = load_class(opts.engine)
+    reference = load_class(opts.reference)
+    # Rewards for every contract, so that the funds are checked too, and
+    # mixed tiers (the milestones' own; the ops' are ignored)
+    ris.catalogue = ris.Catalogue([ris.Milestone('C%d' % (i,),
+                                                 (0, 0, 1, 10)[i % 4],
+                                                 (i + 1) * 1000)
+                                   for i in range(opts.contracts)],
+                                  closed=True)
+    stats = bench.Stats(), bench.Stats()
+    for r in range(opts.rounds):
+        seed = opts.seed + r
+        ops = ris.generate(random.Random(seed), opts.steps, opts.players,
+                           opts.contracts, opts.spread)
+        failed = play(ops, engine, reference, stats)
+        if failed is None:
+            continue
+        i, problems = failed
+        print "Round %d (--seed %d -r 1) failed at operation %d of %d:" % (
+                r, seed, i, len(ops))
+        for p in problems:
+            print "  " + p
+        ops = shrink(ops, engine, reference)
+        print "Shrunk to %d operations:" % (len(ops),)
+        for op in ops:
+            print "  %r" % (op,)
+        print "which fail with:"
+        for p in play(ops, engine, reference)[1]:
+            print "  " + p
+        return 1
+    print "%d rounds of %d operations: no problems" % (opts.rounds, opts.steps)
+    print "== %s" % (opts.engine,)
+    stats[0].report()
+    print "== %s" % (opts.reference,)
+    stats[1].report()
+    over = speed_report(stats[0], stats[1], opts.budget)
+    if over:
+        print "Over budget (%gx the reference): %s" % (opts.budget,
+                                                       ', '.join(over))
+        return 1
+    return 0
+
+def main(opts):
+    # Somewhere for play()'s round trips through the files store
+    tmp = tempfile.mkdtemp(prefix='risfuzz')
+    os.mkdir(os.path.join(tmp, ris.GAMES_DIR))
+    os.mkdir(os.path.join(tmp, ris.JOURNAL_DIR))
+    os.chdir(tmp)
+    try:
+        return run(opts)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,39 @@
+#!/usr/bin/python2
+"""Copies the games in games/ (replaying their journals) into an SQLite
+database, for web.py --db."""
+import optparse
+
+import ris
+
+def parse_args():
+    x = optparse.OptionParser(usage='%prog [options] DATABASE')
+    x.add_option('-f', '--force', action='store_true',
+                 help='Overwrite games that are already in the database')
+    opts, args = x.parse_args()
+    if len(args) != 1:
+        x.error("Expected exactly one database")
+    opts.db = args[0]
+    return opts
+
+def main(opts):
+    db = ris.SQLiteStore(opts.db)
+    existing = set(db.names())
+    # The server may still be running
+    files = ris.FileStore(readonly=True)
+    for name in sorted(ris.files.names()):
+        if name in existing and not opts.force:
+            print "Skipping %s: already in %s" % (name, opts.db)
+            continue
+        try:
+            g = ris.Game.restore(name, files)
+        except Exception as e:
+            print "Failed to load %s (skipping): %r" % (name, e)
+            continue
+        # A game new to the store is always written in full
+        db.save(g)
+        g.journal.close()
+        print "%s: %d players, %d contracts" % (name, len(g.players),
+                                                len(g.contracts))
+
+if __name__ == '__main__':
+    main(parse_args())
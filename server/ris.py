@@ -1,17 +1,116 @@
 #!/usr/bin/python2
+# Also runs on Python 3, for aioweb.py
+from __future__ import print_function
 
 import tempfile
 import json
+import re
 import os
+import bisect
+import random
+import shutil
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+import collections
+import itertools
+import time
+import zlib
+import threading
 
-class Date(object):
-    def __init__(self, year, day):
-        self.year = year
-        self.day = day
-    def __cmp__(self, other):
-        if not isinstance(other, Date):
-            return NotImplemented
-        return cmp((self.year, self.day), (other.year, other.day))
+GAMES_DIR = 'games'
+JOURNAL_DIR = 'journal'
+FIRSTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'GameData', 'RIS', 'Firsts')
+
+# Persistence counters: saves, fsyncs, journal_bytes, snapshot_bytes, rows
+io_stats = collections.Counter()
+io_lock = threading.Lock()
+
+# Numbers the Games made in this process; see Game.version
+incarnations = itertools.count(1)
+
+# Read once, while we're the only thread; see mkstemp()
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def mkstemp(dir):
+    """tempfile.mkstemp(), but with the mode open() would have given the file,
+    rather than 0600, since it is going to be renamed into place."""
+    fd, tmp = tempfile.mkstemp(dir=dir, prefix='.')
+    os.fchmod(fd, 0o666 & ~UMASK)
+    return fd, tmp
+
+def count_io(**kwargs):
+    # Saves may be written from several threads at once
+    with io_lock:
+        io_stats.update(kwargs)
+
+class Histogram(object):
+    """Observations counted into buckets, as for a Prometheus histogram."""
+    SECONDS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10)
+    def __init__(self, buckets=SECONDS):
+        self.buckets = buckets
+        # counts[i] is the number of observations in (buckets[i-1], buckets[i]]
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+    def observe(self, v):
+        with io_lock:
+            self.counts[bisect.bisect_left(self.buckets, v)] += 1
+            self.sum += v
+            self.count += 1
+    def cumulative(self):
+        """[(upper bound, number of observations <= it)], ending with +Inf."""
+        rv, n = [], 0
+        for le, c in zip(self.buckets + (float('inf'),), self.counts):
+            n += c
+            rv.append((le, n))
+        return rv
+
+# Where the time goes; see web.py's /metrics
+histograms = {'update_seconds': Histogram(),
+              'update_resolved': Histogram((0, 1, 2, 5, 10, 20, 50, 100)),
+              'load_seconds': Histogram(),
+              # prepare() is on the reactor; the write is in the thread pool
+              'save_prepare_seconds': Histogram(),
+              'save_write_seconds': Histogram(),
+              'save_bytes': Histogram((100, 1000, 10000, 100000, 1000000)),
+              'save_rows': Histogram((1, 10, 100, 1000, 10000))}
+
+def shard_of(name, shards):
+    """Which of <shards> worker processes owns the game <name>.
+
+    Must agree between processes, so it can't use hash()."""
+    if not isinstance(name, bytes):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) % shards
+
+class Date(int):
+    """A date, packed into an int so that it's small and quick to compare.
+
+    Equal dates are the same object, so it costs nothing to hold lots of them.
+    """
+    __slots__ = ()
+    interned = {}
+    def __new__(cls, year, day):
+        if not 0 <= day <= 365:
+            raise ValueError("Bad day %r" % (day,))
+        # 366, not 365, so that day 0 (of ZERO_DATE) has a slot of its own
+        o = year * 366 + day
+        d = cls.interned.get(o)
+        if d is None:
+            d = cls.interned[o] = int.__new__(cls, o)
+        return d
+    @property
+    def year(self):
+        return int(self) // 366
+    @property
+    def day(self):
+        return int(self) % 366
+    def __repr__(self):
+        return 'Date(%d, %d)' % (self.year, self.day)
     def __str__(self):
         return 'y%02dd%03d' % (self.year, self.day)
     @property
@@ -20,26 +119,132 @@ class Date(object):
     @classmethod
     def load(cls, d):
         return cls(d['year'], d['day'])
+    @classmethod
+    def given(cls, year, day):
+        """The date a client sent, as <year> and <day> (strings, or ints).
+
+        Its days run from 1; only we use day 0, for ZERO_DATE."""
+        day = int(day)
+        if day < 1:
+            raise ValueError("Bad day %r" % (day,))
+        return cls(int(year), day)
+    @classmethod
+    def parse(cls, s):
+        """The inverse of str(), for a date a client sent:
+        Date.parse('y02d100') == Date(2, 100)."""
+        m = re.match(r'y(\d+)d(\d+)$', s)
+        if m is None:
+            raise ValueError("Bad date %r" % (s,))
+        return cls.given(m.group(1), m.group(2))
 
 ZERO_DATE = Date(0, 0) # game starts on Date(1, 1)
 
+class Milestone(object):
+    """A RISMilestone or RISMilestoneGroup, from the client's .cfg files."""
+    __slots__ = ('name', 'tier', 'reward')
+    def __init__(self, name, tier, reward):
+        self.name = name
+        self.tier = tier
+        self.reward = reward
+
+class Catalogue(object):
+    """The table of milestones, by integer id, which is what a Game keys its
+    contracts on; names are only for the protocol and the save formats.
+
+    A closed catalogue, as read by load_catalogue(), only knows() the
+    milestones it was made with.  intern() will still give any other name an
+    id (with no reward), since old saves may have them."""
+    def __init__(self, milestones=(), closed=False):
+        self.names = []
+        self.ids = {}
+        self.tiers = []
+        self.rewards = []
+        for m in milestones:
+            self.intern(m.name, m.tier, m.reward)
+        # ids below this are real milestones
+        self.defined = len(self.names)
+        self.closed = closed
+    def intern(self, name, tier=0, reward=0):
+        """The id of <name>, which is given one if it hasn't one yet."""
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.tiers.append(tier)
+            self.rewards.append(reward)
+        return i
+    def knows(self, name):
+        """Whether clients may complete a contract called <name>."""
+        return not self.closed or self.ids.get(name, self.defined) < self.defined
+    def __len__(self):
+        return self.defined
+
+def load_catalogue(path=FIRSTS_DIR):
+    """Reads the milestones defined in the .cfg files under <path>.
+
+    Returns a closed Catalogue of them, in the order they're defined.
+    """
+    rv = collections.OrderedDict()
+    for fn in sorted(os.listdir(path)):
+        if not fn.endswith('.cfg'):
+            continue
+        node = None
+        with open(os.path.join(path, fn), 'r') as f:
+            for line in f:
+                line = line.split('//', 1)[0].strip()
+                if line in ('RISMilestone', 'RISMilestoneGroup'):
+                    # Same default tiers as the client uses
+                    node = {'tier': 0 if line == 'RISMilestone' else 10}
+                elif line == '}' and node is not None:
+                    rv[node['name']] = Milestone(node['name'],
+                            int(node['tier']),
+                            int(float(node.get('rewardFunds', 0))))
+                    node = None
+                elif '=' in line and node is not None:
+                    k, v = line.split('=', 1)
+                    node[k.strip()] = v.strip()
+    return Catalogue(rv.values(), closed=True)
+
+# The milestones; web.py reads the real ones at startup, before any games are
+# loaded (their contracts' ids are into this)
+catalogue = Catalogue()
+
 class Contract(object):
+    __slots__ = ('id', 'name', 'date', 'results', 'tier', 'firstdate')
     F_UNKNOWN    = 'unknown'
     F_NOT_FIRST  = 'not_first'
     F_WAS_LEADER = 'was_leader'
     F_FIRST      = 'first'
     def __init__(self, name, tier=0):
+        self.id = catalogue.intern(name)
+        if self.id < catalogue.defined:
+            # One of the milestones: its own tier, not what a client says
+            tier = catalogue.tiers[self.id]
         self.name = name
         self.date = {}
         self.results = {}
         self.tier = tier
+        # cached min(self.date.values()), or None if no completions
+        self.firstdate = None
     def complete(self, player, date):
         if player not in self.date:
             self.date[player] = date
-    @property
-    def firstdate(self):
+            if self.firstdate is None or date < self.firstdate:
+                self.firstdate = date
+            if self.results:
+                # Whoever that leaves too late to be first is recorded so,
+                # as a save (and so a reload) would have them, so that they
+                # stay so if the earlier ones part
+                for p, d in self.date.items():
+                    if self.firstdate < d and p not in self.results:
+                        self.results[p] = self.F_NOT_FIRST
+    def remove(self, player):
+        self.date.pop(player, None)
+        self.results.pop(player, None)
         if self.date:
-            return min(self.date.values())
+            self.firstdate = min(self.date.values())
+        else:
+            self.firstdate = None
     def update(self, mindate):
         if not self.date:
             # no-one's completed it yet (so why were we called?)
@@ -84,6 +289,13 @@ class Contract(object):
         return dict((p.name, {'date': self.date[p].dict,
                               'first': self.first(p)})
                     for p in self.date)
+    @property
+    def packed(self):
+        """dict, as a tuple of (player name, date, first); see unpack()."""
+        return tuple((p.name, self.date[p], self.first(p)) for p in self.date)
+    @staticmethod
+    def unpack(packed):
+        return dict((n, {'date': d.dict, 'first': f}) for n, d, f in packed)
     @classmethod
     def load(cls, name, d, players):
         c = cls(name, tier=int(d.get('tier', '0')))
@@ -92,14 +304,22 @@ class Contract(object):
         c.date = dict((players[k],Date.load(v['date'])) for k,v in d.items())
         c.results = dict((players[k],v['first']) for k,v in d.items()
                          if v.get('first', cls.F_UNKNOWN) != cls.F_UNKNOWN)
+        if c.date:
+            c.firstdate = min(c.date.values())
         return c
 
 class Player(object):
+    __slots__ = ('name', 'date', 'leader', 'kia', 'firsts', 'was_leader',
+                 'funds')
     def __init__(self, name):
         self.name = name
         self.date = ZERO_DATE
         self.leader = False
         self.kia = 0
+        # Totals of our results, kept up to date by Game; not saved
+        self.firsts = 0
+        self.was_leader = 0
+        self.funds = 0
     def sync(self, date, kia=None):
         self.date = max(self.date, date)
         if kia is not None:
@@ -118,32 +338,157 @@ class Player(object):
         return p
 
 class Game(object):
+    # Number of recent events to keep for events_since()
+    backlog = 1000
+    # The fields of each type of event, as documented in protocol
+    event_fields = {'join': ('player',), 'part': ('player',), 'lock': (),
+                    'sync': ('player', 'date', 'kia'),
+                    'completed': ('contract', 'player', 'date'),
+                    'result': ('contract', 'results'),
+                    'leader': ('player', 'leader'), 'mindate': ('date',)}
     def __init__(self, name):
         self.name = name
         self.players = {}
         self.contracts = {}
         self.oldmindate = ZERO_DATE
+        # Every date the mindate has advanced to, in order; see at()
+        self.mindates = []
         self.locked = False
+        # Number of mutations applied since the game was created
+        self.seq = 0
+        # Tells us from another game of the same name, whose seq may be ours
+        self.incarnation = next(incarnations)
+        # Where save() puts us; see FileStore and SQLiteStore
+        self.store = files
+        self.journal = None
+        # Recent changes, for clients following the game; see events_since()
+        self.events = []
+        self.evseqs = []
+        self.evbase = 0
+        self.changes = []
+        self.watchers = []
+        self._reindex()
+    def _reindex(self):
+        # Incremental resolution state, so that update() doesn't have to
+        # rescan every contract.
+        # Sorted list of all players' dates; pdates[0] is the mindate
+        self.pdates = sorted(p.date for p in self.players.values())
+        # Sorted list of (firstdate, id) for every unresolved contract that
+        # somebody has completed
+        self.pending = sorted((c.firstdate, c.id)
+                              for c in self.contracts.values()
+                              if c.date and not c.results)
+        # Ids of pending contracts that contract_check() would pass
+        self.ready = set()
+        for fd, i in self.pending:
+            self._recheck(self.contracts[i])
+        # Ids of the contracts each player has completed
+        self.by_player = dict((n, set()) for n in self.players)
+        for c in self.contracts.values():
+            for p in c.date:
+                self.by_player[p.name].add(c.id)
+        self._rehistory()
+        for p in self.players.values():
+            p.firsts = p.was_leader = p.funds = 0
+        for c in self.contracts.values():
+            self._credit(c)
+    def _credit(self, contract):
+        # Add <contract>'s results to its players' totals
+        reward = catalogue.rewards[contract.id]
+        for p, r in contract.results.items():
+            if r == Contract.F_FIRST:
+                p.firsts += 1
+                p.funds += reward
+            elif r == Contract.F_WAS_LEADER:
+                p.was_leader += 1
+    def _rehistory(self):
+        # Sorted list of (date, -tier, id) for every resolved contract, by
+        # the firstdate it was resolved at (a player who joins later can
+        # complete it earlier); the order update() resolves them in, so the
+        # last one up to a date set the leader flags as of that date
+        self.history = sorted((self._resolved_at(c), -c.tier, c.id)
+                              for c in self.contracts.values() if c.results)
+    @staticmethod
+    def _resolved_at(contract):
+        # The date of its firsts.  Not of all its results: a save records
+        # later completers as not_first too, so after a reload they're in
+        # there.  If the firsts have all parted, the firstdate will do, as
+        # there's no telling any more
+        firsts = [contract.date[p] for p, r in contract.results.items()
+                  if r != Contract.F_NOT_FIRST]
+        return min(firsts) if firsts else contract.firstdate
+    def _unpend(self, contract, fd):
+        i = bisect.bisect_left(self.pending, (fd, contract.id))
+        if i < len(self.pending) and self.pending[i] == (fd, contract.id):
+            del self.pending[i]
+    def _recheck(self, contract):
+        # Equivalent to contract_check(), but only looks at the players who
+        # have reached contract.firstdate, rather than at everyone
+        if contract.results or not contract.date:
+            self.ready.discard(contract.id)
+            return
+        fd = contract.firstdate
+        behind = bisect.bisect_right(self.pdates, fd)
+        behind -= sum(1 for p in contract.date if p.date <= fd)
+        if behind:
+            self.ready.discard(contract.id)
+        else:
+            self.ready.add(contract.id)
     @property
     def mindate(self):
-        if not self.players:
+        if not self.pdates:
             return self.oldmindate
-        return min(player.date for player in self.players.values())
+        return self.pdates[0]
     def join(self, player):
         assert player not in self.players, player
-        self.players[player] = Player(player)
+        p = Player(player)
+        self.players[player] = p
+        self.by_player[player] = set()
+        bisect.insort(self.pdates, p.date)
+        # The new player hasn't passed anyone's firstdate yet
+        for i in list(self.ready):
+            self._recheck(self.contracts[i])
+        self._emit('join', player=player)
+        self._log('join', player=player)
     def part(self, player):
         assert player in self.players, player
         p = self.players[player]
-        for contract in self.contracts.values():
-            contract.date.pop(p, None)
-            contract.results.pop(p, None)
+        touched = []
+        resolved = False
+        for contract in self.player_contracts(player):
+            if contract.results:
+                resolved = True
+            else:
+                self._unpend(contract, contract.firstdate)
+            contract.remove(p)
+            touched.append(contract)
         del self.players[player]
+        del self.by_player[player]
+        del self.pdates[bisect.bisect_left(self.pdates, p.date)]
+        for contract in touched:
+            if contract.date and not contract.results:
+                bisect.insort(self.pending, (contract.firstdate, contract.id))
+        # Contracts that player was holding up (and ones that player had
+        # completed) may now be resolvable
+        i = bisect.bisect_left(self.pending, (p.date,))
+        for fd, k in self.pending[i:]:
+            self._recheck(self.contracts[k])
+        for contract in touched:
+            self._recheck(contract)
+        if resolved:
+            # Their firstdates (and even whether they're resolved) may change
+            self._rehistory()
         # The removal of that player might have advanced our mindate.  It also
         # might cause some unintuitive contract behaviour
+        self._emit('part', player=player)
         self.update()
+        self._log('part', player=player)
+    def lock(self):
+        self.locked = True
+        self._emit('lock')
+        self._log('lock')
     def contract_check(self, contract):
-        if not self.players:
+        if not self.players or not contract.date:
             return False
         left = [p for p in self.players.values() if p not in contract.date]
         if not left:
@@ -153,97 +498,1042 @@ class Game(object):
     def update(self):
         if self.mindate < self.oldmindate:
             return
-        new = [(contract.firstdate, -contract.tier, contract)
-               for contract in self.contracts.values()
-               if self.contract_check(contract) and not contract.results]
-        for (d,t,c) in sorted(new):
-            if not c.date:
-                self.contracts.pop(c.name, None)
-                continue
+        start = time.time()
+        new = sorted((c.firstdate, -c.tier, c.id)
+                     for c in (self.contracts[i] for i in self.ready))
+        self.ready.clear()
+        if new:
+            was = dict((k,p.leader) for k,p in self.players.items())
+        for (d,t,i) in new:
+            c = self.contracts[i]
+            self._unpend(c, d)
             leaders = c.update(d)
+            bisect.insort(self.history, (d, t, i))
+            self._credit(c)
             for p in self.players.values():
                 p.leader = p in leaders
+            self._emit('result', contract=c.name, results=c.packed)
+        if new:
+            for k,p in self.players.items():
+                if p.leader != was[k]:
+                    self._emit('leader', player=k, leader=p.leader)
+        self._advance()
+        histograms['update_seconds'].observe(time.time() - start)
+        histograms['update_resolved'].observe(len(new))
+    def _advance(self):
+        # The end of update(): remember the new mindate
+        if self.mindate > self.oldmindate:
+            self.mindates.append(self.mindate)
+            self._emit('mindate', date=self.mindate)
         self.oldmindate = self.mindate
+    def at(self, date):
+        """The standing as of in-game <date>.
+
+        That is, the results (of contracts resolved by then) of the completions
+        up to <date>, the leaders after the last of those resolutions, and how
+        far the mindate had got.  Contracts are taken in the order update()
+        sorts them, by date, even if they were actually resolved in a
+        different order.  The answer is settled if every player has passed
+        <date>, as nothing can then be completed on or before it."""
+        i = bisect.bisect_right(self.history, (date, float('inf')))
+        results = {}
+        for fd, t, k in self.history[:i]:
+            c = self.contracts[k]
+            results[c.name] = dict((p.name, {'date': d.dict, 'first': c.first(p)})
+                              for p, d in c.date.items() if d <= date)
+        leaders = []
+        if i:
+            c = self.contracts[self.history[i - 1][2]]
+            leaders = sorted(p.name for p, r in c.results.items()
+                             if r != Contract.F_NOT_FIRST)
+        j = bisect.bisect_right(self.mindates, date)
+        mindate = self.mindates[j - 1] if j else ZERO_DATE
+        return {'at': date.dict, 'mindate': mindate.dict,
+                'settled': bool(self.players) and date < self.mindate,
+                'leaders': leaders, 'results': results}
     def sync(self, player, date, kia=None):
         assert player in self.players, player
-        self.players[player].sync(date, kia=kia)
+        p = self.players[player]
+        old, oldkia = p.date, p.kia
+        p.sync(date, kia=kia)
+        if old < p.date or oldkia != p.kia:
+            self._emit('sync', player=player, date=p.date, kia=p.kia)
+        if old < p.date:
+            del self.pdates[bisect.bisect_left(self.pdates, old)]
+            bisect.insort(self.pdates, p.date)
+            # We've now passed the firstdate of these contracts
+            lo = bisect.bisect_left(self.pending, (old,))
+            hi = bisect.bisect_left(self.pending, (p.date,))
+            for fd, i in self.pending[lo:hi]:
+                c = self.contracts[i]
+                if p not in c.date:
+                    self._recheck(c)
         self.update()
+        self._log('sync', player=player, date=date.dict, kia=kia)
     @property
     def dict(self):
         return {'mindate': self.mindate.dict,
                 'players': dict((k,v.dict) for k,v in self.players.items())}
     def complete(self, contract, player, date, tier=0):
         assert player in self.players, player
-        player = self.players[player]
+        self._complete(contract, self.players[player], date, tier)
+        self._log('complete', contract=contract, player=player, date=date.dict,
+                  tier=tier)
+    def _complete(self, contract, player, date, tier):
         # If date < player.date, that means we already sync'd a future date.
         # To avoid breakage, we use the sync date rather than the date supplied
         # with the completion message.
         date = max(date, player.date)
-        if contract not in self.contracts:
-            self.contracts[contract] = Contract(contract, tier=tier)
-        self.contracts[contract].complete(player, date)
+        cid = catalogue.intern(contract)
+        c = self.contracts.get(cid)
+        if c is None:
+            c = self.contracts[cid] = Contract(contract, tier=tier)
+        if player in c.date:
+            return
+        self.by_player[player.name].add(cid)
+        self._emit('completed', contract=contract, player=player.name,
+                   date=date)
+        if c.results:
+            was = self._resolved_at(c)
+            c.complete(player, date)
+            if self._resolved_at(c) != was:
+                self._rehistory()
+            return
+        if c.date:
+            self._unpend(c, c.firstdate)
+        c.complete(player, date)
+        bisect.insort(self.pending, (c.firstdate, cid))
+        self._recheck(c)
+    def batch(self, player, completions, date, kia=None):
+        """Several completions followed by a sync, journalled as one record.
+
+        <completions> is a list of (contract, date, tier) tuples."""
+        journal, self.journal = self.journal, None
+        try:
+            for contract, cdate, tier in completions:
+                self.complete(contract, player, cdate, tier=tier)
+            self.sync(player, date, kia=kia)
+        finally:
+            self.journal = journal
+        self._log('batch', player=player, date=date.dict, kia=kia,
+                  completions=[(c, d.dict, t) for c,d,t in completions])
+    @property
+    def leaderboard(self):
+        """Every player's totals, by player name."""
+        return dict((k, {'firsts': p.firsts, 'was_leader': p.was_leader,
+                         'funds': p.funds, 'kia': p.kia})
+                    for k,p in self.players.items())
+    def player_contracts(self, player):
+        """The contracts the player named <player> has completed."""
+        return [self.contracts[i] for i in self.by_player[player]]
+    def contract(self, name):
+        """The contract called <name>, or None if nobody has completed it."""
+        i = catalogue.ids.get(name)
+        return None if i is None else self.contracts.get(i)
     def results(self, contract):
-        if contract not in self.contracts:
+        c = self.contract(contract)
+        if c is None:
             return {}
-        return self.contracts[contract].dict
+        return c.dict
+    @property
+    def version(self):
+        """Changes whenever the game does, even if it was removed, and another
+        made with the same name."""
+        return (self.incarnation, self.seq)
     @property
     def save_dict(self):
         return {'oldmindate': self.oldmindate.dict,
+                'mindates': [d.dict for d in self.mindates],
                 'players': dict((k,v.dict) for k,v in self.players.items()),
-                'contracts': dict((k,v.save_dict)
-                                  for k,v in self.contracts.items()),
-                'locked': self.locked}
+                'contracts': dict((c.name,c.save_dict)
+                                  for c in self.contracts.values()),
+                'locked': self.locked,
+                'seq': self.seq}
+    def _emit(self, kind, **kwargs):
+        # Kept as a tuple of (kind, fields...), in event_fields order, with
+        # Dates and packed results, as dicts would take several times the
+        # memory; event() makes the dict a client sees
+        self.changes.append((kind,) + tuple(kwargs[k]
+                                            for k in self.event_fields[kind]))
+    @classmethod
+    def event(cls, e):
+        """The dict form of an event, from its (seq, kind, fields...) tuple."""
+        d = {'seq': e[0], 'type': e[1]}
+        for k, v in zip(cls.event_fields[e[1]], e[2:]):
+            if k == 'results':
+                v = Contract.unpack(v)
+            elif isinstance(v, Date):
+                v = v.dict
+            d[k] = v
+        return d
+    def _log(self, op, **kwargs):
+        # Called at the end of each mutation: journal it, and publish the
+        # changes it made to our watchers
+        self.seq += 1
+        if self.journal is not None:
+            kwargs.update(op=op, seq=self.seq)
+            self.journal.append(kwargs)
+        if not self.changes:
+            return
+        new = [(self.seq,) + e for e in self.changes]
+        self.changes = []
+        self.events.extend(new)
+        self.evseqs.extend(e[0] for e in new)
+        # Trimmed a quarter at a time, so that each del is paid for by the
+        # events appended since the last
+        if len(self.events) > self.backlog + self.backlog // 4:
+            cut = len(self.events) - self.backlog
+            self.evbase = self.evseqs[cut - 1]
+            # Don't keep half of a mutation's events
+            cut = bisect.bisect_right(self.evseqs, self.evbase)
+            del self.events[:cut]
+            del self.evseqs[:cut]
+        if self.watchers:
+            new = [self.event(e) for e in new]
+            for cb in list(self.watchers):
+                cb(new)
+    def events_since(self, since):
+        """Events with seq greater than <since>, oldest first.
+
+        Returns None if some of those have already been discarded (or were
+        never known, since they happened before we were loaded)."""
+        if since < self.evbase:
+            return None
+        return [self.event(e) for e in
+                self.events[bisect.bisect_right(self.evseqs, since):]]
+    def watch(self, cb):
+        """Call cb(events) with each mutation's events, or cb(None) on rm()."""
+        self.watchers.append(cb)
+    def unwatch(self, cb):
+        if cb in self.watchers:
+            self.watchers.remove(cb)
+    def apply(self, rec):
+        """Redo a mutation recorded by _log()."""
+        op = rec['op']
+        if op == 'join':
+            self.join(rec['player'])
+        elif op == 'part':
+            self.part(rec['player'])
+        elif op == 'lock':
+            self.lock()
+        elif op == 'sync':
+            self.sync(rec['player'], Date.load(rec['date']), kia=rec['kia'])
+        elif op == 'complete':
+            self.complete(rec['contract'], rec['player'],
+                          Date.load(rec['date']), tier=rec['tier'])
+        elif op == 'batch':
+            self.batch(rec['player'],
+                       [(c, Date.load(d), t) for c,d,t in rec['completions']],
+                       Date.load(rec['date']), kia=rec['kia'])
+        else:
+            raise ValueError("Bad journal op %r" % (op,))
     def save(self):
-        # XXX this will trash the save if we crash!
-        with open(os.path.join('games', self.name), "w") as f:
-            json.dump(self.save_dict, f)
+        self.store.save(self)
     def rm(self):
-        os.remove(os.path.join('games', self.name))
+        self.store.remove(self)
+        self.gone()
+    def gone(self):
+        """Tell our watchers that we've been removed."""
+        for cb in list(self.watchers):
+            cb(None)
     @classmethod
     def load(cls, name, f):
         d = json.load(f)
         f.close()
+        return cls.from_dict(name, d)
+    @classmethod
+    def from_dict(cls, name, d):
         g = cls(name)
         g.oldmindate = Date.load(d['oldmindate'])
+        g.mindates = [Date.load(m) for m in d.get('mindates', [])]
         g.players = dict((k,Player.load(k, v)) for k,v in d['players'].items())
-        g.contracts = dict((k,Contract.load(k, v, g.players))
-                           for k,v in d['contracts'].items())
+        g.contracts = dict((c.id,c) for c in
+                           (Contract.load(k, v, g.players)
+                            for k,v in d['contracts'].items()))
         g.locked = d.get('locked', False)
+        g.seq = d.get('seq', 0)
+        g.evbase = g.seq
+        g._reindex()
         return g
+    @classmethod
+    def restore(cls, name, store=None):
+        """Load game <name> from <store> (by default, games/)."""
+        return (store or files).restore(name, cls)
+
+class Journal(object):
+    """Append-only log of the mutations to a Game since its last snapshot.
+
+    Records are buffered by append() and written out, with a single fsync, by
+    commit(); a game is durable once its save() has returned.  commit() is
+    also split into take(), which must be called from the game's thread, and
+    write(), which needn't.
+    """
+    # Number of records after which Game.save() takes a new snapshot instead
+    limit = 1000
+    def __init__(self, name):
+        self.path = os.path.join(JOURNAL_DIR, name)
+        self.f = None
+        self.buf = []
+        self.count = 0
+    @property
+    def full(self):
+        return self.count + len(self.buf) >= self.limit
+    def append(self, rec):
+        # Serialised by write(); nothing in a record is changed afterwards
+        self.buf.append(rec)
+    def take(self):
+        recs, self.buf = self.buf, []
+        self.count += len(recs)
+        return recs
+    def write(self, recs):
+        if not recs:
+            return
+        if self.f is None:
+            self.f = open(self.path, 'a')
+        data = ''.join(json.dumps(rec) + '\n' for rec in recs)
+        self.f.write(data)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        count_io(journal_bytes=len(data), fsyncs=1)
+        histograms['save_bytes'].observe(len(data))
+    def commit(self):
+        self.write(self.take())
+    def replay(self, truncate=True):
+        """Read back the committed records.
+
+        A torn record at the end (from a crash during commit()) was never
+        acknowledged, so it is discarded, and cut off so that the records we
+        append follow the good ones.  Only the journal's owner may do that:
+        to anyone else, the torn record may be one the server is still
+        writing, so they should pass truncate=False."""
+        if not os.path.exists(self.path):
+            return []
+        recs = []
+        good = 0
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    recs.append(json.loads(line))
+                except ValueError:
+                    break
+                good += len(line)
+            f.seek(0, os.SEEK_END)
+            if f.tell() > good and truncate:
+                print("Discarding torn journal record in %s" % (self.path,))
+                with open(self.path, 'r+') as w:
+                    w.truncate(good)
+        self.count = len(recs)
+        return recs
+    def clear(self):
+        # Everything so far is going into a snapshot; truncate() once it has
+        self.buf = []
+        self.count = 0
+    def truncate(self):
+        if self.f is not None:
+            self.f.close()
+        self.f = open(self.path, 'w')
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class FileStore(object):
+    """Each game as a JSON snapshot in games/, plus a Journal of the mutations
+    made since it was taken.
+
+    A read-only FileStore, for the offline tools, never writes anything; not
+    even to cut a torn record off a journal, since the server may be running
+    and still writing it."""
+    def __init__(self, readonly=False):
+        self.readonly = readonly
+    def names(self):
+        # Skipping our index, and temporary files from snapshot()
+        return [fn for fn in os.listdir(GAMES_DIR) if not fn.startswith('.')]
+    def stamp(self, name):
+        # Changes whenever the game's files do, so we can tell if an index
+        # entry is stale (e.g. because we crashed before writing the index)
+        st = os.stat(os.path.join(GAMES_DIR, name))
+        journal = os.path.join(JOURNAL_DIR, name)
+        if os.path.exists(journal):
+            jsize = os.path.getsize(journal)
+        else:
+            jsize = 0
+        return [st.st_mtime, st.st_size, jsize]
+    def restore(self, name, cls=None):
+        """Load the latest snapshot of game <name> and replay its journal."""
+        g = (cls or Game).load(name, open(os.path.join(GAMES_DIR, name), 'r'))
+        g.store = self
+        journal = Journal(name)
+        for rec in journal.replay(truncate=not self.readonly):
+            if rec['seq'] > g.seq:
+                g.apply(rec)
+        g.journal = journal
+        return g
+    def save(self, game):
+        self.prepare(game)()
+    def prepare(self, game):
+        """Returns a function that does save()'s writing, from any thread.
+
+        What it writes is copied from <game> now, so the game may go on
+        changing meanwhile; but the writes for a game must be run in order."""
+        if self.readonly:
+            raise IOError("Game '%s' was loaded read-only" % (game.name,))
+        count_io(saves=1)
+        if game.journal is None or game.journal.full:
+            return self.prepare_snapshot(game)
+        recs = game.journal.take()
+        return lambda: game.journal.write(recs)
+    def prepare_snapshot(self, game):
+        d = game.save_dict
+        if game.journal is None:
+            game.journal = Journal(game.name)
+        journal = game.journal
+        journal.clear()
+        return lambda: self.snapshot(game.name, d, journal)
+    def snapshot(self, name, d, journal):
+        # Write to a temporary file and rename it over the old snapshot, so
+        # that a crash leaves us with either the old or the new one.
+        fd, tmp = mkstemp(GAMES_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(d, f)
+            f.flush()
+            os.fsync(f.fileno())
+            count_io(snapshot_bytes=f.tell(), fsyncs=1)
+            histograms['save_bytes'].observe(f.tell())
+        os.rename(tmp, os.path.join(GAMES_DIR, name))
+        # If we crash before this, load will skip the records by their seq
+        journal.truncate()
+    def close(self, game):
+        write = self.prepare_close(game)
+        if write is not None:
+            write()
+    def prepare_close(self, game):
+        """As prepare(), for close(): returns a function that compacts <game>,
+        so that loading it again is a single read, and closes its journal."""
+        if self.readonly:
+            return game.journal.close
+        if game.journal is None or game.journal.count or game.journal.buf:
+            write = self.prepare_snapshot(game)
+            journal = game.journal
+            def run():
+                write()
+                journal.close()
+            return run
+        return game.journal.close
+    def remove(self, game):
+        if self.readonly:
+            raise IOError("Game '%s' was loaded read-only" % (game.name,))
+        os.remove(os.path.join(GAMES_DIR, game.name))
+        if game.journal is not None:
+            game.journal.remove()
+    def read_index(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+    def write_index(self, path, index):
+        fd, tmp = mkstemp(GAMES_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp, path)
+
+# The default store
+files = FileStore()
+
+class SQLiteStore(object):
+    """All the games in one SQLite database, a row per player, contract,
+    completion and result.
+
+    save() only rewrites the rows that the game's events since the last save()
+    say have changed; the whole game is rewritten only if those events have
+    dropped out of its backlog, or if a player has left.
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS games (name TEXT PRIMARY KEY,
+        oldmindate INTEGER, locked INTEGER, seq INTEGER);
+    CREATE TABLE IF NOT EXISTS players (game TEXT, player TEXT, date INTEGER,
+        leader INTEGER, kia INTEGER, PRIMARY KEY (game, player));
+    CREATE TABLE IF NOT EXISTS contracts (game TEXT, contract TEXT,
+        tier INTEGER, PRIMARY KEY (game, contract));
+    CREATE TABLE IF NOT EXISTS completions (game TEXT, contract TEXT,
+        player TEXT, date INTEGER, PRIMARY KEY (game, contract, player));
+    CREATE INDEX IF NOT EXISTS completions_player
+        ON completions (game, player);
+    CREATE TABLE IF NOT EXISTS results (game TEXT, contract TEXT,
+        player TEXT, first TEXT, PRIMARY KEY (game, contract, player));
+    CREATE INDEX IF NOT EXISTS results_player ON results (game, player);
+    CREATE TABLE IF NOT EXISTS mindates (game TEXT, date INTEGER,
+        PRIMARY KEY (game, date));
+    """
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        # Shared with the threads that write saves, one at a time
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        # Same durability as the journal's fsync: a game is on disk once its
+        # save() has returned
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.executescript(self.schema)
+        # game name: seq at which we last wrote it
+        self.saved = {}
+    def names(self):
+        with self.lock:
+            return [n for n, in self.db.execute('SELECT name FROM games')]
+    def stamp(self, name):
+        # Every save() writes the game's seq
+        with self.lock:
+            row = self.db.execute('SELECT seq FROM games WHERE name = ?',
+                                  (name,)).fetchone()
+        return row and row[0]
+    def restore(self, name, cls=None):
+        with self.lock:
+            d = self.read(name)
+        g = (cls or Game).from_dict(name, d)
+        g.store = self
+        self.saved[name] = g.seq
+        return g
+    def read(self, name):
+        q = lambda sql: self.db.execute(sql, (name,))
+        row = q('SELECT oldmindate, locked, seq FROM games WHERE name = ?'
+                ).fetchone()
+        if row is None:
+            raise KeyError(name)
+        oldmindate, locked, seq = row
+        d = {'oldmindate': self._date(oldmindate).dict, 'locked': bool(locked),
+             'seq': seq, 'players': {}, 'contracts': {},
+             'mindates': [self._date(m).dict for m, in
+                          q('SELECT date FROM mindates WHERE game = ? '
+                            'ORDER BY date')]}
+        for p, date, leader, kia in q('SELECT player, date, leader, kia '
+                                      'FROM players WHERE game = ?'):
+            d['players'][p] = {'date': self._date(date).dict,
+                               'leader': bool(leader), 'kia': kia}
+        for c, tier in q('SELECT contract, tier FROM contracts '
+                         'WHERE game = ?'):
+            d['contracts'][c] = {'players': {}, 'tier': tier}
+        for c, p, date in q('SELECT contract, player, date FROM completions '
+                            'WHERE game = ?'):
+            d['contracts'][c]['players'][p] = {'date': self._date(date).dict}
+        for c, p, first in q('SELECT contract, player, first FROM results '
+                             'WHERE game = ?'):
+            d['contracts'][c]['players'][p]['first'] = first
+        return d
+    @staticmethod
+    def _date(n):
+        return Date(*divmod(n, 366))
+    def save(self, game):
+        self.prepare(game)()
+    def prepare(self, game):
+        """Returns a function that does save()'s writing, from any thread.
+
+        The rows it writes are copied from <game> now, as for
+        FileStore.prepare()."""
+        count_io(saves=1)
+        name = game.name
+        since = self.saved.get(name)
+        events = None if since is None else game.events_since(since)
+        if events is not None and any(e['type'] == 'part' for e in events):
+            # Which contracts lost results isn't recorded; players rarely
+            # leave, so just rewrite everything
+            events = None
+        if events is None:
+            # New to us, or we've lost track: write the whole thing
+            players = game.players.keys()
+            contracts = [c.name for c in game.contracts.values()]
+            mindates = game.mindates
+        else:
+            players, contracts, mindates = set(), set(), []
+            for e in events:
+                kind = e['type']
+                if kind in ('join', 'sync', 'leader'):
+                    players.add(e['player'])
+                elif kind == 'mindate':
+                    mindates.append(Date.load(e['date']))
+                elif kind == 'completed':
+                    contracts.add(e['contract'])
+                elif kind == 'result':
+                    contracts.add(e['contract'])
+                    # the leader flags may have moved
+                    players.update(game.players)
+        rows = {'games': [(name, int(game.oldmindate), int(game.locked),
+                           game.seq)],
+                'players': [], 'contracts': [], 'completions': [],
+                'results': [],
+                'mindates': [(name, int(d)) for d in mindates]}
+        for k in players:
+            p = game.players[k]
+            rows['players'].append((name, k, int(p.date), int(p.leader), p.kia))
+        for k in contracts:
+            c = game.contract(k)
+            rows['contracts'].append((name, k, c.tier))
+            rows['completions'].extend((name, k, p.name, int(date))
+                                       for p, date in c.date.items())
+            if c.results:
+                # Like save_dict, which records late completions as not_first
+                rows['results'].extend((name, k, p.name, c.first(p))
+                                       for p in c.date)
+        self.saved[name] = game.seq
+        return lambda: self.write(name, events is None, contracts, rows)
+    def write(self, name, full, contracts, rows):
+        with self.lock:
+            db = self.db
+            if full:
+                for table in ('players', 'contracts', 'completions', 'results',
+                              'mindates'):
+                    db.execute('DELETE FROM %s WHERE game = ?' % (table,),
+                               (name,))
+            else:
+                db.executemany('DELETE FROM results WHERE game = ? AND '
+                               'contract = ?', ((name, k) for k in contracts))
+            n = 0
+            for table in ('games', 'players', 'contracts', 'completions',
+                          'results', 'mindates'):
+                if not rows[table]:
+                    continue
+                marks = ', '.join('?' * len(rows[table][0]))
+                db.executemany('INSERT OR REPLACE INTO %s VALUES (%s)' %
+                               (table, marks), rows[table])
+                n += len(rows[table])
+            db.commit()
+        count_io(fsyncs=1, rows=n)
+        histograms['save_rows'].observe(n)
+    def close(self, game):
+        self.saved.pop(game.name, None)
+    def prepare_close(self, game):
+        # Nothing to write
+        self.close(game)
+    def remove(self, game):
+        self.saved.pop(game.name, None)
+        with self.lock:
+            for table in ('games', 'players', 'contracts', 'completions',
+                          'results', 'mindates'):
+                key = 'name' if table == 'games' else 'game'
+                self.db.execute('DELETE FROM %s WHERE %s = ?' % (table, key),
+                                (game.name,))
+            self.db.commit()
+    def read_index(self, path):
+        # Always up to date, so there's no need for an index file
+        with self.lock:
+            games = self.db.execute('SELECT name, locked, oldmindate, seq '
+                                    'FROM games').fetchall()
+            players = self.db.execute('SELECT game, player, date FROM players '
+                                      'ORDER BY game, player').fetchall()
+        index = {}
+        for name, locked, oldmindate, seq in games:
+            index[name] = {'players': [], 'mindate': oldmindate,
+                           'locked': bool(locked), 'stamp': seq}
+        for name, player, date in players:
+            ent = index[name]
+            if not ent['players'] or date < ent['mindate']:
+                ent['mindate'] = date
+            ent['players'].append(player)
+        for ent in index.values():
+            ent['mindate'] = self._date(ent['mindate']).dict
+        return index
+    def write_index(self, path, index):
+        return
+
+class SnapshotStore(object):
+    """Read-only copies of games, published by one server (web.py --publish)
+    for mirrors (web.py --mirror) to serve.
+
+    Each game is its save_dict, written to a temporary file and renamed into
+    place, so that a reader always sees a whole one; there is no journal."""
+    def __init__(self, path):
+        self.path = path
+    def names(self):
+        return [fn for fn in os.listdir(self.path) if not fn.startswith('.')]
+    def stamp(self, name):
+        # Every publish() makes a new file, so the inode changes too
+        st = os.stat(os.path.join(self.path, name))
+        return [st.st_mtime, st.st_size, st.st_ino]
+    def restore(self, name, cls=None):
+        g = (cls or Game).load(name, open(os.path.join(self.path, name), 'r'))
+        g.store = self
+        return g
+    def publish(self, name, d):
+        """Write <d>, a save_dict, as game <name>; from any thread."""
+        fd, tmp = mkstemp(self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(d, f)
+        # No fsync: a mirror's copy can always be published again
+        os.rename(tmp, os.path.join(self.path, name))
+    def unpublish(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+    def save(self, game):
+        self.prepare(game)()
+    def prepare(self, game):
+        raise IOError("Game '%s' is a read-only copy" % (game.name,))
+    def close(self, game):
+        pass
+    def prepare_close(self, game):
+        pass
+    def remove(self, game):
+        raise IOError("Game '%s' is a read-only copy" % (game.name,))
+    # The directory is the publisher's, so mirrors keep no index in it
+    def read_index(self, path):
+        return {}
+    def write_index(self, path, index):
+        pass
+
+class GameTable(object):
+    """All the games on the server, loaded on first use and evicted when idle.
+
+    Behaves enough like a dict of name: Game for web.py's purposes.  Unloaded
+    games are represented by their summary(), which is kept in an index (by
+    the store) so that listing the games doesn't require loading them all.
+    """
+    def __init__(self, idle=None, maxloaded=None, strict=False, shard=None,
+                 store=None):
+        self.store = store or files
+        # Seconds unused after which a game is evicted
+        self.idle = idle
+        # Maximum number of games to keep loaded
+        self.maxloaded = maxloaded
+        self.strict = strict
+        # (i, n): only look after the games that shard_of() puts in shard i
+        self.shard = shard
+        if shard is None:
+            self.index = os.path.join(GAMES_DIR, '.index')
+        else:
+            self.index = os.path.join(GAMES_DIR, '.index.%d' % (shard[0],))
+        self.names = set()
+        self.summaries = {}
+        # Each game's store.stamp() when we last looked; see refresh()
+        self.stamps = {}
+        # Least recently used first
+        self.loaded = collections.OrderedDict()
+        self.used = {}
+        # Bumped whenever a game is added or removed
+        self.serial = 0
+    def scan(self):
+        index = self.store.read_index(self.index)
+        for fn in self.store.names():
+            if self.shard is not None and shard_of(fn, self.shard[1]) != self.shard[0]:
+                # another worker's
+                continue
+            ent = index.get(fn)
+            self.stamps[fn] = self.store.stamp(fn)
+            if ent is not None and ent['stamp'] == self.stamps[fn]:
+                self.names.add(fn)
+                self.summaries[fn] = {'players': ent['players'],
+                                      'mindate': Date.load(ent['mindate']),
+                                      'locked': ent['locked']}
+                continue
+            try:
+                self._load(fn)
+            except Exception:
+                if self.strict:
+                    raise
+        self.write_index()
+    def refresh(self):
+        """Reload the games that have changed in our store since we last
+        looked, and pick up new and removed ones; for a mirror, whose store
+        is written by another process."""
+        names = set(self.store.names())
+        for name in self.names - names:
+            del self[name]
+        for name in names:
+            try:
+                stamp = self.store.stamp(name)
+            except OSError:
+                # removed since names()
+                continue
+            if self.stamps.get(name) == stamp:
+                continue
+            self.stamps[name] = stamp
+            self.serial += 1
+            try:
+                self._load(name)
+            except Exception:
+                if self.strict:
+                    raise
+    def _load(self, name):
+        self.names.add(name)
+        start = time.time()
+        try:
+            g = Game.restore(name, self.store)
+        except Exception as e:
+            print("Failed to load %s (skipping): %r" % (name, e))
+            del self[name]
+            raise
+        histograms['load_seconds'].observe(time.time() - start)
+        self.summaries.pop(name, None)
+        self.loaded[name] = g
+        return g
+    @property
+    def version(self):
+        """Changes whenever any game's summary() might have."""
+        return (self.serial,
+                tuple(sorted((n, g.version) for n,g in self.loaded.items())))
+    def summary(self, name):
+        if name in self.loaded:
+            g = self.loaded[name]
+            return {'players': sorted(g.players), 'mindate': g.mindate,
+                    'locked': g.locked}
+        return self.summaries[name]
+    def __contains__(self, name):
+        return name in self.names
+    def __iter__(self):
+        return iter(self.names)
+    def __len__(self):
+        return len(self.names)
+    def __getitem__(self, name):
+        if name in self.loaded:
+            g = self.loaded.pop(name)
+            self.loaded[name] = g
+        elif name in self.names:
+            g = self._load(name)
+        else:
+            raise KeyError(name)
+        self.used[name] = time.time()
+        return g
+    def __setitem__(self, name, game):
+        game.store = self.store
+        self.serial += 1
+        self.names.add(name)
+        self.summaries.pop(name, None)
+        self.loaded.pop(name, None)
+        self.loaded[name] = game
+        self.used[name] = time.time()
+    def __delitem__(self, name):
+        self.serial += 1
+        self.names.discard(name)
+        self.stamps.pop(name, None)
+        self.summaries.pop(name, None)
+        self.loaded.pop(name, None)
+        self.used.pop(name, None)
+    def evictable(self, keep=()):
+        """The games that evict() would unload, least recently used first."""
+        now = time.time()
+        n = len(self.loaded)
+        names = []
+        for name in self.loaded:
+            over = self.maxloaded is not None and n > self.maxloaded
+            stale = self.idle is not None and now - self.used.get(name, 0) > self.idle
+            if not (over or stale):
+                break
+            if self.loaded[name].watchers or name in keep:
+                # someone is following it on /events, or it's being saved
+                continue
+            names.append(name)
+            n -= 1
+        return names
+    def unload(self, name):
+        """Drop game <name>, which its store has closed, but not its summary."""
+        self.summaries[name] = self.summary(name)
+        del self.loaded[name]
+        self.used.pop(name, None)
+    def evict(self, keep=()):
+        """Unload the games that have been idle too long, except those in
+        <keep>."""
+        names = self.evictable(keep)
+        for name in names:
+            self.store.close(self.loaded[name])
+            self.unload(name)
+        if names:
+            self.write_index()
+    def write_index(self):
+        index = {}
+        for name in self.names:
+            s = self.summary(name)
+            index[name] = {'players': s['players'], 'mindate': s['mindate'].dict,
+                           'locked': s['locked'],
+                           'stamp': self.store.stamp(name)}
+        self.store.write_index(self.index, index)
+
+class RescanGame(Game):
+    """Reference implementation of Game.update(), which rescans every contract.
+
+    Used by difftest() to check the incremental engine; too slow for real use.
+    """
+    def update(self):
+        if self.mindate < self.oldmindate:
+            return
+        new = [(contract.firstdate, -contract.tier, contract.id, contract)
+               for contract in self.contracts.values()
+               if self.contract_check(contract) and not contract.results]
+        for (d,t,n,c) in sorted(new):
+            leaders = c.update(d)
+            for p in self.players.values():
+                p.leader = p in leaders
+        self._advance()
+        self._reindex()
+
+def later(date, days):
+    """<date> moved on by <days> (which may be negative), but not to before
+    ZERO_DATE."""
+    n = max(date.year * 365 + date.day - 1 + days, 0)
+    return Date(n // 365, n % 365 + 1)
+
+def generate(rng, steps, players=8, contracts=24, spread=10):
+    """A random race, for difftest() and fuzz.py, as (method, args...) tuples.
+
+    Contracts are named C0, C1...; dates are close together, so that same-day
+    ties, late completions and players leaving mid-race come up often.  A
+    model of who is in the game, and how far they've got, keeps most of the
+    operations valid; callers skip the rest.  ('restore', how) asks for the
+    game to be saved and loaded again; see reload()."""
+    names = ['P%d' % (i,) for i in range(players)]
+    cnames = ['C%d' % (i,) for i in range(contracts)]
+    present = {}
+    locked = False
+    ops = []
+    def completion(pname):
+        return (rng.choice(cnames), later(present[pname],
+                                          rng.randint(-2, spread)),
+                rng.choice([0, 0, 1, 10]))
+    for s in range(steps):
+        op = rng.random()
+        if locked and op < 0.08:
+            # Nobody may join or leave a locked game
+            op = rng.uniform(0.08, 1)
+        if op < 0.05 or not present:
+            pname = rng.choice(names)
+            if pname in present:
+                continue
+            present[pname] = ZERO_DATE
+            ops.append(('join', pname))
+        elif op < 0.08:
+            pname = rng.choice(sorted(present))
+            del present[pname]
+            ops.append(('part', pname))
+        elif op < 0.1:
+            ops.append(('restore',
+                        rng.choice(['snapshot', 'journal', 'sqlite'])))
+        elif op < 0.102:
+            locked = True
+            ops.append(('lock',))
+        elif op < 0.45:
+            pname = rng.choice(sorted(present))
+            present[pname] = later(present[pname], rng.randint(0, spread))
+            kia = rng.choice([None, None, None, rng.randint(0, 5)])
+            ops.append(('sync', pname, present[pname], kia))
+        elif op < 0.6:
+            pname = rng.choice(sorted(present))
+            done = [completion(pname) for i in range(rng.randint(0, 3))]
+            present[pname] = later(present[pname], rng.randint(0, spread))
+            kia = rng.choice([None, None, None, rng.randint(0, 5)])
+            ops.append(('batch', pname, done, present[pname], kia))
+        else:
+            pname = rng.choice(sorted(present))
+            cname, date, tier = completion(pname)
+            ops.append(('complete', cname, pname, date, tier))
+    return ops
+
+def reload(g, how, db=None):
+    """<g>, saved and loaded again as a new game of its class: by a
+    'snapshot' or a 'journal' (onto the last snapshot) in the files store,
+    through SQLiteStore <db> ('sqlite'), or as a 'json' save_dict."""
+    cls = type(g)
+    if how == 'json':
+        return cls.load(g.name, StringIO(json.dumps(g.save_dict)))
+    if how == 'sqlite':
+        db.save(g)
+        return cls.restore(g.name, db)
+    if how == 'snapshot':
+        files.prepare_snapshot(g)()
+    else:
+        files.save(g)
+    g.journal.close()
+    return cls.restore(g.name, files)
 
 def test():
     g = Game('Test')
     g.join('P1')
     g.join('P2')
     g.sync('P1', Date(1, 1))
-    print g.dict
+    print(g.dict)
     g.sync('P2', Date(1, 2))
-    print g.dict
-    print "P1 FS"
+    print(g.dict)
+    print("P1 FS")
     g.complete('FirstSatellite', 'P1', Date(1, 3))
     g.sync('P1', Date(1, 3))
-    print g.results('FirstSatellite')
-    print g.dict
-    print "P2 sync"
+    print(g.results('FirstSatellite'))
+    print(g.dict)
+    print("P2 sync")
     g.sync('P2', Date(1, 4))
-    print g.results('FirstSatellite')
-    print g.dict
-    print "P2 FS"
+    print(g.results('FirstSatellite'))
+    print(g.dict)
+    print("P2 FS")
     g.complete('FirstSatellite', 'P2', Date(1, 4))
-    print g.results('FirstSatellite')
-    print g.dict
-    print "P2 CO"
+    print(g.results('FirstSatellite'))
+    print(g.dict)
+    print("P2 CO")
     g.complete('CrewedOrbit', 'P2', Date(1, 5))
     g.sync('P2', Date(1, 5))
-    print g.results('CrewedOrbit')
-    print "P1 sync"
+    print(g.results('CrewedOrbit'))
+    print("P1 sync")
     g.sync('P1', Date(1, 5))
-    print g.results('CrewedOrbit')
-    print g.dict
-    print "P1 CO"
+    print(g.results('CrewedOrbit'))
+    print(g.dict)
+    print("P1 CO")
     g.complete('CrewedOrbit', 'P1', Date(1, 5))
-    print g.results('CrewedOrbit')
-    print g.dict
+    print(g.results('CrewedOrbit'))
+    print(g.dict)
+
+def difftest(rounds=40, steps=300, seed=0):
+    """Check Game's incremental update() against RescanGame's full rescan,
+    and the stores' round trips against the games they were given."""
+    global catalogue, GAMES_DIR, JOURNAL_DIR
+    rng = random.Random(seed)
+    # So that the players' funds are checked too; the tiers are the
+    # milestones', whatever generate() says
+    saved = catalogue, GAMES_DIR, JOURNAL_DIR
+    catalogue = Catalogue([Milestone('C%d' % (i,), (0, 0, 1, 10)[i % 4],
+                                     (i + 1) * 1000)
+                           for i in range(24)], closed=True)
+    tmp = tempfile.mkdtemp(prefix='risdifftest')
+    GAMES_DIR = os.path.join(tmp, 'games')
+    JOURNAL_DIR = os.path.join(tmp, 'journal')
+    os.mkdir(GAMES_DIR)
+    os.mkdir(JOURNAL_DIR)
+    try:
+        for r in range(rounds):
+            games = [Game('Test'), RescanGame('Test')]
+            # Also check that SQLiteStore's row-level saves keep up
+            store = SQLiteStore(':memory:')
+            games[0].store = store
+            games[0].save()
+            for s, args in enumerate(generate(rng, steps)):
+                if args[0] == 'restore':
+                    games = [reload(games[0], args[1], store),
+                             reload(games[1], 'json')]
+                    games[0].store = store
+                elif args[0] == 'join' and args[1] in games[0].players:
+                    continue
+                elif args[0] not in ('join', 'lock') and \
+                        args[2 if args[0] == 'complete' else 1] not in \
+                        games[0].players:
+                    continue
+                else:
+                    for g in games:
+                        getattr(g, args[0])(*args[1:])
+                games[0].save()
+                probe = later(ZERO_DATE, rng.randint(0, 150))
+                a, b = [(g.save_dict, g.dict,
+                         sorted((k, sorted(v)) for k,v in g.by_player.items()),
+                         g.at(probe), g.leaderboard)
+                        for g in games]
+                assert a == b, (r, s, args, a, b)
+            if games[0].journal is not None:
+                games[0].journal.close()
+    finally:
+        catalogue, GAMES_DIR, JOURNAL_DIR = saved
+        shutil.rmtree(tmp)
 
 if __name__ == '__main__':
     test()
+    difftest()
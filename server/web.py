@@ -1,41 +1,119 @@
 #!/usr/bin/python2
 from nevow import tags as t
 from nevow.flat import flatten
-from twisted.web import server, resource, static
-from twisted.internet import reactor, endpoints
+from twisted.web import server, resource, static, http, client
+from twisted.internet import (reactor, endpoints, task, defer, protocol, error,
+                              threads)
 import optparse
+import sys
 import json
-import urllib
+import urlparse
 import pprint
 import os
+import collections
+import shutil
+import tempfile
+import time
 
 import ris
+import common
+from common import EPERM, ENOENT, Failed, ActionFailed, dumps
 
-# We cannot import errno, because the errno values aren't the same on all
-# platforms; we standardise on the Linux values for RIS protocol purposes
-EPERM = 1
-ENOENT = 2
-EEXIST = 17
-EINVAL = 22
-ENOTEMPTY = 39
-
-main_css = """
-table { border: 1px solid; }
-th,td { border: 1px solid gray; }
-td.num { text-align: right; }
-"""
-
-games = {}
-
-class Failed(Exception):
-    def __init__(self, msg, code=None):
-        self.msg = msg
-        self.code = code
-
-class Page(resource.Resource):
-    """Abstract base class for pages with both data and human-readable forms."""
+# Whether to believe X-Forwarded-For; only shard workers, which listen on the
+# loopback interface, should
+trust_proxy = False
+
+class Flusher(common.Flusher):
+    """common.Flusher on the reactor, writing in its thread pool; its waiters
+    are Deferreds."""
+    def waiter(self):
+        return defer.Deferred()
+    def fire(self, d, error=None):
+        if error is None:
+            d.callback(None)
+        else:
+            d.errback(error)
+    def later(self, delay, fn):
+        return reactor.callLater(delay, fn)
+    def cancel(self, call):
+        if call.active():
+            call.cancel()
+    def call_in_thread(self, fn, done):
+        d = threads.deferToThread(fn)
+        d.addCallbacks(lambda _: done(None), lambda f: done(f.value))
+    def drain(self):
+        """A Deferred that fires once everything has been saved."""
+        return defer.DeferredList(common.Flusher.drain(self))
+
+flusher = Flusher()
+common.flusher = flusher
+
+class Publisher(object):
+    """Keeps a read-only copy of every game in a ris.SnapshotStore, for
+    mirrors to serve, so that spectators needn't load the server itself.
+
+    publish() is called every few seconds, rather than on each save, so that
+    a busy game costs one copy per call; each copy is written after the game's
+    earlier writes, in the thread pool."""
+    def __init__(self, store):
+        self.store = store
+        # game name: version of its last published copy
+        self.published = {}
+    def start(self):
+        # Games we haven't published, which we'd otherwise only get round to
+        # once somebody loaded them
+        have = set(self.store.names())
+        for name in list(common.games):
+            if name not in have:
+                common.games[name]
+        self.publish()
+    def publish(self):
+        """Publish the loaded games that have changed since we last did, and
+        unpublish the ones that have been removed."""
+        for name, g in common.games.loaded.items():
+            if self.published.get(name) == g.version:
+                continue
+            self.published[name] = g.version
+            d = g.save_dict
+            w = flusher.submit(name, lambda name=name, d=d:
+                                     self.store.publish(name, d))
+            w.addErrback(self.failed, name)
+        for name in [n for n in self.published if n not in common.games]:
+            del self.published[name]
+            w = flusher.submit(name, lambda name=name:
+                                     self.store.unpublish(name))
+            w.addErrback(self.failed, name)
+    def failed(self, f, name):
+        print "Failed to publish %s: %s" % (name, f.getErrorMessage())
+        # Try again next time
+        self.published.pop(name, None)
+
+# The Publisher, if --publish was given
+publisher = None
+
+def esc(text):
+    """<text> escaped and encoded as nevow.flat.flatten() would."""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def attr(text):
+    return esc(text).replace('"', '&quot;')
+
+class Page(resource.Resource, common.Page):
+    """common.Page, served by twisted.web."""
     isLeaf = True
     
+    def render(self, request):
+        start = time.time()
+        rv = resource.Resource.render(self, request)
+        hist = common.request_seconds[self.__class__.__name__]
+        if rv is server.NOT_DONE_YET:
+            request.notifyFinish().addBoth(
+                lambda _: hist.observe(time.time() - start))
+        else:
+            hist.observe(time.time() - start)
+        return rv
     def flatten_args(self, request):
         for k in request.args.keys():
             v = request.args[k]
@@ -45,7 +123,12 @@ class Page(resource.Resource):
                     request.args[k] = v[0]
                 elif not l:
                     del request.args[k]
-        request.args['_local'] = request.getClientIP() == '127.0.0.1'
+        request.args['_local'] = self.client_ip(request) == '127.0.0.1'
+    def client_ip(self, request):
+        if trust_proxy:
+            # We're a shard worker, behind the front process
+            return request.getHeader('x-forwarded-for') or request.getClientIP()
+        return request.getClientIP()
     def render_GET(self, request):
         self.flatten_args(request)
         try:
@@ -56,351 +139,371 @@ class Page(resource.Resource):
             return self.error(request, repr(e))
         if request.args.get('json'):
             try:
-                d = self.data(**request.args)
-                request.setHeader("content-type", "application/json")
-                return json.dumps(d)
+                etag, body = self.json_response(request)
             except Exception as e:
                 return self.error(request, repr(e))
-        page = t.html[t.head[t.title['KSP Race Into Space server'],
-                             t.link(rel='stylesheet', href='main.css')],
-                      t.body[self.content(**request.args)]]
+            if request.setETag(etag) == http.CACHED:
+                return ''
+            return body
         request.setHeader("content-type", "text/html")
-        return flatten(page)
+        try:
+            return self.render_html(request)
+        except Exception as e:
+            return self.error(request, repr(e))
+    def render_html(self, request):
+        """The page from html(), from the cache if possible.
+
+        If it's a big one, it's sent stream_after bytes at a time, rather than
+        holding everyone else up while it's put together."""
+        args = request.args
+        version = self.version(**args)
+        if version is not None:
+            key = self.cache_key('html', args, version)
+            body = common.cache.get(key)
+            if body is not None:
+                return body
+        chunks = [common.PAGE_HEAD]
+        size = 0
+        pieces = self.html(**args)
+        for chunk in pieces:
+            chunks.append(chunk)
+            size += len(chunk)
+            if self.stream_after is not None and size > self.stream_after:
+                break
+        else:
+            chunks.append(common.PAGE_TAIL)
+            body = ''.join(chunks)
+            if version is not None:
+                common.cache.put(key, body)
+            return body
+        request.write(''.join(chunks))
+        def more():
+            for chunk in pieces:
+                if lost:
+                    return
+                chunks.append(chunk)
+                request.write(chunk)
+                yield
+            chunks.append(common.PAGE_TAIL)
+            request.write(common.PAGE_TAIL)
+            if version is not None:
+                common.cache.put(key, ''.join(chunks))
+        def done(_):
+            if not lost:
+                request.finish()
+        def failed(f):
+            print "Failed to render %s: %s" % (request.uri, f.getErrorMessage())
+            if not lost:
+                request.finish()
+        lost = []
+        request.notifyFinish().addErrback(lambda f: lost.append(True))
+        task.cooperate(more()).whenDone().addCallbacks(done, failed)
+        return server.NOT_DONE_YET
+    # Bytes of a page to put together before sending it in pieces; None to
+    # never do so
+    stream_after = 65536
+    def html(self, **kwargs):
+        """Yields the body of the human-readable page, in pieces.
+
+        Anything it needs from the game must be copied before the first yield,
+        since the game may change before it's asked for the next piece.  This
+        default flattens content(); the busiest pages skip nevow, and write out
+        the same markup directly."""
+        yield flatten(self.content(**kwargs))
     def content(self, **kwargs):
         """Subclasses should probably override this with something prettier."""
-        return t.pre(pprint.pformat(self.data(**kwargs)))
-    def validate(self, **kwargs):
-        return
-    def error(self, request, msg, code=None):
-        if request.args.get('json'):
-            request.setHeader("content-type", "application/json")
-            d = {'err': msg}
-            if code is not None:
-                d['code'] = code
-            return json.dumps(d)
+        return t.pre[pprint.pformat(self.data(**kwargs))]
+    def error_html(self, msg):
         page = t.html[t.head[t.title['KSP Race Into Space server'],
                              t.link(rel='stylesheet', href='main.css')],
                       t.body[t.h1["Error"],
                              t.h2[msg]]]
-        request.setHeader("content-type", "text/html")
         return flatten(page)
-    def query_string(self, **kwargs):
-        return '?' + '&'.join('%s=%s' % (k, urllib.quote_plus(v))
-                              for k,v in kwargs.items() if v is not None)
+    def when_saved(self, request, name, respond):
+        """Finish the request with respond() once game <name> has been saved."""
+        d = flusher.wait(name)
+        if d is None:
+            return respond()
+        def done(_):
+            return respond()
+        def failed(f):
+            return self.error(request, "Failed to save game: %s" %
+                                       (f.getErrorMessage(),))
+        def finish(body):
+            # A streamed page finishes the request itself
+            if not lost and body is not server.NOT_DONE_YET:
+                request.write(body)
+                request.finish()
+        lost = []
+        request.notifyFinish().addErrback(lambda f: lost.append(True))
+        d.addCallbacks(done, failed)
+        d.addCallback(finish)
+        return server.NOT_DONE_YET
 
-class Index(Page):
-    def data(self, **kwargs):
-        return dict((n,{'players': list(games[n].players.keys()),
-                        'mindate': games[n].mindate.dict})
-                    for n in games)
-    def content(self, **kwargs):
-        yield t.h1["KSP Race Into Space server"]
-        yield t.h2["Games in progress"]
-        header = t.tr[t.th["Name"], t.th["Players"], t.th["Min. Date"]]
-        rows = [t.form(method='GET', action='/rmgame')[t.tr[
-                    t.td[t.a(href="/game" + self.query_string(name=n))[n]],
-                    t.td[", ".join(games[n].players.keys())],
-                    t.td[str(games[n].mindate)],
-                    t.td if games[n].locked or not kwargs.get('_local') else
-                    t.td[t.input(type='hidden', name='game', value=n),
-                         t.input(type='submit', value='End')]
-                    ]]
-                for n in sorted(games)]
-        rows.append(t.form(method='GET', action='/newgame')[t.tr[
-                        t.td[t.input(type='text', name='name')],
-                        t.td(colspan=2),
-                        t.td[t.input(type='submit', value='New')]]])
-        yield t.table[header, rows]
-
-class ActionFailed(Failed): pass
+class Index(common.Index, Page):
+    def html(self, **kwargs):
+        summaries = sorted(self.summaries().items())
+        yield ('<h1>KSP Race Into Space server</h1><h2>Games in progress</h2>'
+               '<table><tr><th>Name</th><th>Players</th><th>Min. Date</th></tr>')
+        for n, s in summaries:
+            if s['locked'] or not kwargs.get('_local'):
+                end = '<td />'
+            else:
+                end = ('<td><input name="game" type="hidden" value="%s" />'
+                       '<input type="submit" value="End" /></td>' % (attr(n),))
+            yield ('<form action="/rmgame" method="GET"><tr>'
+                   '<td><a href="/game%s">%s</a></td><td>%s</td><td>%s</td>'
+                   '%s</tr></form>' % (attr(self.query_string(name=n)), esc(n),
+                                       esc(", ".join(s['players'])),
+                                       s['mindate'], end))
+        yield ('<form action="/newgame" method="GET"><tr>'
+               '<td><input name="name" type="text" /></td><td colspan="2"></td>'
+               '<td><input type="submit" value="New" /></td></tr></form>'
+               '</table>')
 
 class Action(Page):
     def render_GET(self, request):
         self.flatten_args(request)
+        rejected = self.admit(request)
+        if rejected is not None:
+            return rejected
         try:
             dest = self.act(**request.args)
         except ActionFailed as e:
             return self.error(request, e.msg, e.code)
         except Exception as e:
             return self.error(request, str(e))
-        request.redirect(dest)
-        return ''
-
-class NewGame(Action):
-    def act(self, **kwargs):
-        name = kwargs.get('name')
-        if not name:
-            raise ActionFailed("No name specified for new game.", EINVAL)
-        if name in games:
-            raise ActionFailed("There is already a game named '%s'." % (name,),
-                            EEXIST)
-        if '/' in name:
-            raise ActionFailed("Game name may not contain '/'.", EINVAL)
-        games[name] = ris.Game(name)
-        games[name].save()
-        return '/game' + self.query_string(name=name, json=kwargs.get('json'))
-
-class RmGame(Action):
-    def act(self, **kwargs):
-        name = kwargs.get('game')
-        if not name:
-            raise ActionFailed("No game specified.", EINVAL)
-        if name not in games:
-            raise ActionFailed("There is no game named '%s'." % (name,), ENOENT)
-        game = games[name]
-        if game.locked or not kwargs.get('_local'):
-            raise ActionFailed("Game is locked.", EPERM)
-        if game.players:
-            raise ActionFailed("Game '%s' has %d players." % (name, len(game.players)),
-                               ENOTEMPTY)
-        game.rm()
-        del games[name]
-        return '/' + self.query_string(json=kwargs.get('json'))
-
-class Game(Page):
-    def validate(self, **kwargs):
-        name = kwargs.get('name')
-        if not name:
-            raise Failed("No name specified.", EINVAL)
-        if name not in games:
-            raise Failed("No such game '%s'." % (name,), ENOENT)
-    def data(self, name, **kwargs):
-        return games[name].dict
-    def content(self, name, **kwargs):
-        game = games[name]
+        def respond():
+            if request.args.get('inline'):
+                return self.inline(request, dest)
+            request.redirect(dest)
+            return ''
+        name = request.args.get('game') or request.args.get('name')
+        return self.when_saved(request, name, respond)
+    def inline(self, request, dest):
+        """Renders <dest> as our response, saving the client a redirect."""
+        path, _, query = dest.partition('?')
+        request.args = urlparse.parse_qs(query)
+        return root.children[path.lstrip('/')].render_GET(request)
+
+class NewGame(common.NewGame, Action): pass
+class RmGame(common.RmGame, Action): pass
+
+class Game(common.Game, Page):
+    def html(self, name, **kwargs):
+        game = common.games[name]
         admin = kwargs.get('_local') and not game.locked
-        yield t.h1["Game: ", name]
-        yield t.h2["Min. Date: ", str(game.mindate)]
-        yield t.h2["Players"]
-        header = t.tr[t.th["Name"], t.th["Date"], t.th["Cem'y"], t.th,
-                      [] if game.locked else t.th]
-        rows = [t.form(method='GET', action='/part')[t.tr[
-                     t.td[t.a(href="/player" +
-                              self.query_string(game=name, name=n)
-                              )[n]],
-                     t.td[str(game.players[n].date)],
-                     t.td(Class='num')[str(game.players[n].kia)],
-                     t.td['Leader' if game.players[n].leader else []],
-                     [] if not admin else
-                     t.td[t.input(type='hidden', name='game', value=name),
-                          t.input(type='hidden', name='name', value=n),
-                          t.input(type='submit', value='Remove')],
-                     ]]
-                for n in sorted(game.players)]
-        rows.append(t.form(method='GET', action='/join')[
-                t.input(type='hidden', name='game', value=name),
-                t.tr[t.td[t.input(type='text', name='name')],
-                     t.td(colspan=2),
-                     [] if not admin else
-                     t.td[t.input(type='submit', value='New')]]])
-        if admin:
-            yield t.form(method='GET', action='/lock')[
-                    t.input(type='hidden', name='game', value=name),
-                    t.input(type='submit', value='Lock')]
-        yield t.table[header, rows]
+        players = [(n, game.players[n].date, game.players[n].kia,
+                    game.players[n].leader) for n in sorted(game.players)]
         def shortresult(contract):
             front = [p for p in contract.date
                      if contract.date[p] == contract.firstdate]
             text = ['%s, %s, %s'%(p.name, contract.date[p], contract.first(p))
                     for p in front]
             return '(%s)'%('; '.join(text))
-        yield t.h2["Contracts"]
-        yield t.ul[[t.li[t.a(href="/result" + self.query_string(game=name,
-                                                                contract=n))[n],
-                         ': ', shortresult(game.contracts[n])]
-                    for n in sorted(game.contracts,
-                                    key=lambda n:game.contracts[n].firstdate)]]
-
-class Player(Page):
-    def validate(self, **kwargs):
-        name = kwargs.get('game')
-        if not name:
-            raise Failed("No game specified.", EINVAL)
-        if name not in games:
-            raise Failed("No such game '%s'." % (name,), ENOENT)
-        game = games[name]
-        pname = kwargs.get('name')
-        if not pname:
-            raise Failed("No player specified.", EINVAL)
-        if pname not in game.players:
-            raise Failed("No such player '%s'." % (pname,), ENOENT)
-    def data(self, game, name, **kwargs):
-        game = games[game]
-        player = game.players[name]
-        return dict((contract.name,{'date': contract.date[player],
-                                    'first': contract.first(player)})
-                    for contract in game.contracts.values()
-                    if player in contract.date)
-    def content(self, game, name, **kwargs):
-        game = games[game]
+        # Contracts whose players have all left have no firstdate; they go last
+        contracts = [(c.name, shortresult(c))
+                     for c in sorted(game.contracts.values(),
+                                     key=lambda c:(c.firstdate is None,
+                                                   c.firstdate))]
+        locked = game.locked
+        yield '<h1>Game: %s</h1><h2>Min. Date: %s</h2><h2>Players</h2>' % (
+                esc(name), game.mindate)
+        hidden = '<input name="game" type="hidden" value="%s" />' % (attr(name),)
+        if admin:
+            yield ('<form action="/lock" method="GET">%s'
+                   '<input type="submit" value="Lock" /></form>' % (hidden,))
+        yield ('<table><tr><th>Name</th><th>Date</th><th>Cem\'y</th><th />%s'
+               '</tr>' % ('' if locked else '<th />',))
+        rows = []
+        for n, date, kia, leader in players:
+            if admin:
+                remove = ('<td>%s<input name="name" type="hidden" value="%s" />'
+                          '<input type="submit" value="Remove" /></td>' %
+                          (hidden, attr(n)))
+            else:
+                remove = ''
+            rows.append('<form action="/part" method="GET"><tr>'
+                        '<td><a href="/player%s">%s</a></td><td>%s</td>'
+                        '<td Class="num">%d</td><td>%s</td>%s</tr></form>' % (
+                            attr(self.query_string(game=name, name=n)), esc(n),
+                            date, kia, 'Leader' if leader else '', remove))
+        yield ''.join(rows)
+        yield ('<form action="/join" method="GET">%s<tr>'
+               '<td><input name="name" type="text" /></td><td colspan="2"></td>'
+               '%s</tr></form></table><h2>Contracts</h2><ul>' % (hidden,
+                '<td><input type="submit" value="New" /></td>' if admin else ''))
+        # There can be a lot of these
+        for i in range(0, len(contracts), 100):
+            yield ''.join('<li><a href="/result%s">%s</a>: %s</li>' % (
+                              attr(self.query_string(game=name, contract=n)),
+                              esc(n), esc(r))
+                          for n, r in contracts[i:i+100])
+        yield '</ul>'
+
+class Player(common.Player, Page):
+    def html(self, game, name, **kwargs):
+        game = common.games[game]
         player = game.players[name]
-        yield t.h1["Player: ", player.name]
-        yield t.h2["Date: ", str(player.date)]
+        contracts = [(c.name, c.date[player], c.first(player))
+                     for c in sorted(game.player_contracts(name),
+                                     key=lambda c:c.date[player])]
+        yield '<h1>Player: %s</h1><h2>Date: %s</h2>' % (esc(player.name),
+                                                        player.date)
         if player.kia:
-            yield t.h2["%d astronauts K.I.A." % (player.kia,)]
+            yield '<h2>%d astronauts K.I.A.</h2>' % (player.kia,)
         if player.leader:
-            yield t.h2["Has Leader flag"]
-        contracts = [c for c in game.contracts.values() if player in c.date]
-        header = t.tr[t.th["Contract"], t.th["Date"], t.th["Result"]]
-        rows = [t.tr[t.td[t.a(href="/result" +
-                              self.query_string(game=game.name, contract=c.name)
-                              )[c.name]],
-                     t.td[str(c.date[player])],
-                     t.td[c.first(player)]]
-                for c in sorted(contracts, key=lambda c:c.date[player])]
-        yield t.table[header, rows]
-
-class Result(Page):
-    def validate(self, **kwargs):
-        name = kwargs.get('game')
-        if not name:
-            raise Failed("No game specified.", EINVAL)
-        if name not in games:
-            raise Failed("No such game '%s'." % (name,), ENOENT)
-        game = games[name]
-        cname = kwargs.get('contract')
-        if not cname:
-            raise Failed("No contract specified.", EINVAL)
-        if cname not in game.contracts:
-            raise Failed("No such contract '%s'." % (cname,), ENOENT)
-    def data(self, game, contract, **kwargs):
-        return games[game].contracts[contract].dict
-    def content(self, game, contract, **kwargs):
-        game = games[game]
-        contract = game.contracts[contract]
-        yield t.h1["Contract: ", contract.name]
-        yield t.h2["Firstdate: ", str(contract.firstdate)]
-        yield t.h2["Results"]
-        header = t.tr[t.th["Player"], t.th["Date"], t.th["Result"]]
-        rows = [t.tr[t.td[t.a(href="/player" +
-                              self.query_string(game=game.name, name=p.name)
-                              )[p.name]],
-                     t.td[str(contract.date[p])],
-                     t.td[contract.first(p)]]
-                for p in sorted(contract.date, key=lambda p:contract.date[p])]
-        yield t.table[header, rows]
-
-class Lock(Action):
-    def act(self, **kwargs):
-        gname = kwargs.get('game')
-        if not gname:
-            raise ActionFailed("No game name specified.", EINVAL)
-        if gname not in games:
-            raise ActionFailed("No such game '%s'." % (gname,), ENOENT)
-        game = games[gname]
-        if not kwargs.get('_local'):
-            raise ActionFailed("You're not the server administrator.", EPERM)
-        game.locked = True
-        game.save()
-        return '/game' + self.query_string(name=gname, json=kwargs.get('json'))
-
-class Join(Action):
-    def act(self, **kwargs):
-        gname = kwargs.get('game')
-        if not gname:
-            raise ActionFailed("No game name specified.", EINVAL)
-        if gname not in games:
-            raise ActionFailed("No such game '%s'." % (gname,), ENOENT)
-        game = games[gname]
-        if game.locked:
-            raise ActionFailed("Game is locked.", EPERM)
-        name = kwargs.get('name')
-        if not name:
-            raise ActionFailed("No player name specified.", EINVAL)
-        if name in game.players:
-            raise ActionFailed("There is already a player named '%s'." % (name,),
-                            EEXIST)
-        game.join(name)
-        game.save()
-        return '/game' + self.query_string(name=gname, json=kwargs.get('json'))
-
-class Part(Action):
-    def act(self, **kwargs):
-        gname = kwargs.get('game')
-        if not gname:
-            raise ActionFailed("No game name specified.", EINVAL)
-        if gname not in games:
-            raise ActionFailed("No such game '%s'." % (gname,), ENOENT)
-        game = games[gname]
-        if game.locked:
-            raise ActionFailed("Game is locked.", EPERM)
-        name = kwargs.get('name')
-        if not name:
-            raise ActionFailed("No player name specified.", EINVAL)
-        if name not in game.players:
-            raise ActionFailed("There is no player named '%s'." % (name,),
-                               ENOENT)
-        game.part(name)
-        game.save()
-        return '/game' + self.query_string(name=gname, json=kwargs.get('json'))
-
-class Sync(Action):
-    def act(self, **kwargs):
-        gname = kwargs.get('game')
-        if not gname:
-            raise ActionFailed("No game name specified.", EINVAL)
-        if gname not in games:
-            raise ActionFailed("No such game '%s'." % (gname,), ENOENT)
-        game = games[gname]
-        pname = kwargs.get('player')
-        if not pname:
-            raise ActionFailed("No player name specified.", EINVAL)
-        if pname not in game.players:
-            raise ActionFailed("There is no player named '%s'." % (pname,),
-                               ENOENT)
-        year = kwargs.get('year')
-        if not year:
-            raise ActionFailed("No year specified.", EINVAL)
-        day = kwargs.get('day')
-        if not day:
-            raise ActionFailed("No day specified.", EINVAL)
+            yield '<h2>Has Leader flag</h2>'
+        yield ('<table><tr><th>Contract</th><th>Date</th><th>Result</th>'
+               '</tr>')
+        for i in range(0, len(contracts), 100):
+            yield ''.join('<tr><td><a href="/result%s">%s</a></td><td>%s</td>'
+                          '<td>%s</td></tr>' % (
+                              attr(self.query_string(game=game.name,
+                                                     contract=n)),
+                              esc(n), date, esc(first))
+                          for n, date, first in contracts[i:i+100])
+        yield '</table>'
+
+class Result(common.Result, Page):
+    def html(self, game, contract, **kwargs):
+        game = common.games[game]
+        contract = game.contract(contract)
+        players = [(p.name, contract.date[p], contract.first(p))
+                   for p in sorted(contract.date, key=lambda p:contract.date[p])]
+        yield ('<h1>Contract: %s</h1><h2>Firstdate: %s</h2><h2>Results</h2>'
+               '<table><tr><th>Player</th><th>Date</th><th>Result</th></tr>' %
+               (esc(contract.name), contract.firstdate))
+        yield ''.join('<tr><td><a href="/player%s">%s</a></td><td>%s</td>'
+                      '<td>%s</td></tr>' % (
+                          attr(self.query_string(game=game.name, name=n)),
+                          esc(n), date, esc(first))
+                      for n, date, first in players)
+        yield '</table>'
+
+class History(common.History, Page):
+    def html(self, game, at, **kwargs):
+        d = common.games[game].at(ris.Date.parse(at))
+        rows = sorted((ris.Date.load(r['date']), c, p, r['first'])
+                      for c, res in d['results'].items()
+                      for p, r in res.items())
+        yield ('<h1>Game: %s</h1><h2>As of %s</h2><h2>Min. Date: %s%s</h2>'
+               '<h2>Leaders: %s</h2>' % (
+                   esc(game), ris.Date.load(d['at']),
+                   ris.Date.load(d['mindate']),
+                   '' if d['settled'] else ' (not yet settled)',
+                   esc(", ".join(d['leaders'])) or 'none'))
+        yield ('<table><tr><th>Contract</th><th>Player</th><th>Date</th>'
+               '<th>Result</th></tr>')
+        for i in range(0, len(rows), 100):
+            yield ''.join('<tr><td><a href="/result%s">%s</a></td>'
+                          '<td><a href="/player%s">%s</a></td><td>%s</td>'
+                          '<td>%s</td></tr>' % (
+                              attr(self.query_string(game=game, contract=c)),
+                              esc(c),
+                              attr(self.query_string(game=game, name=p)),
+                              esc(p), date, esc(first))
+                          for date, c, p, first in rows[i:i+100])
+        yield '</table>'
+
+class Leaderboard(common.Leaderboard, Page):
+    def html(self, game, **kwargs):
+        board = sorted(common.games[game].leaderboard.items(),
+                       key=lambda (name, total): (-total['funds'],
+                                                  -total['firsts'], name))
+        yield ('<h1>Game: %s</h1><h2>Leaderboard</h2><table><tr>'
+               '<th>Player</th><th>Funds</th><th>Firsts</th><th>Was Leader</th>'
+               '<th>K.I.A.</th></tr>' % (esc(game),))
+        yield ''.join('<tr><td><a href="/player%s">%s</a></td>'
+                      '<td Class="num">%d</td><td Class="num">%d</td>'
+                      '<td Class="num">%d</td><td Class="num">%d</td></tr>' % (
+                          attr(self.query_string(game=game, name=name)),
+                          esc(name), total['funds'], total['firsts'],
+                          total['was_leader'], total['kia'])
+                      for name, total in board)
+        yield '</table>'
+
+class Lock(common.Lock, Action): pass
+class Join(common.Join, Action): pass
+class Part(common.Part, Action): pass
+class Sync(common.Sync, Action): pass
+class Completed(common.Completed, Action): pass
+
+class Batch(common.Batch, Page):
+    def render_GET(self, request):
+        self.flatten_args(request)
+        rejected = self.admit(request)
+        if rejected is not None:
+            return rejected
+        body = Page.render_GET(self, request)
+        return self.when_saved(request, request.args.get('game'),
+                               lambda: body)
+
+class Events(common.Events, Page):
+    def render_GET(self, request):
+        self.flatten_args(request)
         try:
-            kia = int(kwargs.get('kia', 0))
-        except ValueError:
-            raise ActionFailed("Bad 'kia' value '%s'." % (kwargs['kia'],),
-                               EINVAL)
-        game.sync(pname, ris.Date(int(year), int(day)), kia=kia)
-        game.save()
-        return '/game' + self.query_string(name=gname, json=kwargs.get('json'))
-
-class Completed(Action):
-    def act(self, **kwargs):
-        gname = kwargs.get('game')
-        if not gname:
-            raise ActionFailed("No game name specified.", EINVAL)
-        if gname not in games:
-            raise ActionFailed("No such game '%s'." % (gname,), ENOENT)
-        game = games[gname]
-        pname = kwargs.get('player')
-        if not pname:
-            raise ActionFailed("No player name specified.", EINVAL)
-        if pname not in game.players:
-            raise ActionFailed("There is no player named '%s'." % (pname,),
-                               ENOENT)
-        year = kwargs.get('year')
-        if not year:
-            raise ActionFailed("No year specified.", EINVAL)
-        day = kwargs.get('day')
-        if not day:
-            raise ActionFailed("No day specified.", EINVAL)
-        cname = kwargs.get('contract')
-        if not cname:
-            raise ActionFailed("No contract specified.", EINVAL)
+            self.validate(**request.args)
+        except Failed as e:
+            return self.error(request, e.msg, e.code)
+        game, since = self.start(request)
+        if request.args.get('stream'):
+            return self.stream(request, game, since)
+        if not self.waits(request, game, since):
+            return Page.render_GET(self, request)
+        # Nothing new yet, so wait for the next mutation (or the timeout)
+        def wake(events):
+            if done:
+                return
+            stop()
+            request.write(self.woken(request, game, since, events))
+            request.finish()
+        def stop(failure=None):
+            done.append(True)
+            game.unwatch(wake)
+            if timer.active():
+                timer.cancel()
+        done = []
+        game.watch(wake)
+        timer = reactor.callLater(self.timeout, wake, [])
+        request.notifyFinish().addErrback(stop)
+        return server.NOT_DONE_YET
+    def stream(self, request, game, since):
+        def send(events):
+            request.write(self.stream_events(events))
+            if events is None:
+                stop()
+                request.finish()
+        def stop(failure=None):
+            game.unwatch(send)
+            if ping.running:
+                ping.stop()
+        request.write(self.stream_start(request, game, since))
+        game.watch(send)
+        ping = task.LoopingCall(request.write, self.PING)
+        ping.start(self.timeout, now=False)
+        request.notifyFinish().addBoth(stop)
+        return server.NOT_DONE_YET
+
+class Admin(Page):
+    """A page for the server administrator only; see common.Admin."""
+    def render_GET(self, request):
+        self.flatten_args(request)
+        if not request.args.get('_local'):
+            return self.error(request, "You're not the server administrator.",
+                              EPERM)
         try:
-            tier = int(kwargs.get('tier', 0))
-        except ValueError:
-            raise ActionFailed("Bad 'tier' value '%s'." % (kwargs['tier'],),
-                               EINVAL)
-        game.complete(cname, pname, ris.Date(int(year), int(day)),
-                      tier=tier)
-        game.save()
-        return '/result' + self.query_string(game=gname, contract=cname,
-                                             json=kwargs.get('json'))
+            return self.text(request, **request.args)
+        except Failed as e:
+            return self.error(request, e.msg, e.code)
+
+class Metrics(common.Metrics, Admin): pass
+class Profile(common.Profile, Admin): pass
 
 root = resource.Resource()
 root.putChild('', Index())
 root.putChild('index.htm', Index())
-root.putChild('main.css', static.Data(main_css, 'text/css'))
+root.putChild('main.css', static.Data(common.main_css, 'text/css'))
 root.putChild('newgame', NewGame())
 root.putChild('rmgame', RmGame())
 root.putChild('game', Game())
@@ -410,36 +513,387 @@ root.putChild('part', Part())
 root.putChild('sync', Sync())
 root.putChild('player', Player())
 root.putChild('result', Result())
+root.putChild('history', History())
+root.putChild('leaderboard', Leaderboard())
 root.putChild('completed', Completed())
+root.putChild('batch', Batch())
+root.putChild('events', Events())
+root.putChild('metrics', Metrics())
+root.putChild('profile', Profile())
+
+class ReadOnly(Page):
+    """What a mirror serves in place of the pages that change games (and of
+    /events, since it doesn't see the changes, only the results)."""
+    def render_GET(self, request):
+        self.flatten_args(request)
+        return self.error(request, "This server is a read-only mirror.", EPERM)
+
+class Summaries(Page):
+    """A shard worker's games, for the front process's Index."""
+    def version(self, **kwargs):
+        return common.games.version
+    def data(self, **kwargs):
+        return dict((n, {'players': s['players'], 'mindate': s['mindate'].dict,
+                         'locked': s['locked']})
+                    for n,s in ((n, common.games.summary(n))
+                                for n in common.games))
+
+class ShardIndex(Index):
+    """Index of the games on all the shards."""
+    # render_GET() has to have the whole page at once
+    stream_after = None
+    def __init__(self, ports):
+        Index.__init__(self)
+        self.ports = ports
+        self.agent = client.Agent(reactor)
+        self.fetched = {}
+    def version(self, **kwargs):
+        return None
+    def summaries(self):
+        return self.fetched
+    def fetch(self, port):
+        url = 'http://127.0.0.1:%d/summaries?json=1' % (port,)
+        d = self.agent.request('GET', url)
+        d.addCallback(client.readBody)
+        d.addCallback(json.loads)
+        return d
+    def render_GET(self, request):
+        d = defer.gatherResults([self.fetch(p) for p in self.ports],
+                                consumeErrors=True)
+        def done(results):
+            fetched = {}
+            for r in results:
+                for n, s in r.items():
+                    fetched[n] = dict(s, mindate=ris.Date.load(s['mindate']))
+            # Nothing else can run before Page.render_GET() has used it
+            self.fetched = fetched
+            try:
+                request.write(Page.render_GET(self, request))
+            finally:
+                self.fetched = {}
+        def failed(f):
+            request.write(self.error(request, "Shard unavailable: %s" %
+                                              (f.getErrorMessage(),)))
+        d.addCallbacks(done, failed)
+        d.addBoth(lambda _: request.finish())
+        return server.NOT_DONE_YET
+
+class Relay(protocol.Protocol):
+    """Copies the body of a shard worker's response to our client."""
+    def __init__(self, request, finished):
+        self.request = request
+        self.finished = finished
+    def dataReceived(self, data):
+        self.request.write(data)
+    def connectionLost(self, reason):
+        self.finished.callback(None)
+
+class ShardRouter(resource.Resource):
+    """Forwards each request to the shard worker that owns its game.
+
+    Connections to the workers are kept open, and reused for later requests."""
+    isLeaf = True
+    def __init__(self, ports):
+        resource.Resource.__init__(self)
+        self.ports = ports
+        pool = client.HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = 16
+        self.agent = client.Agent(reactor, pool=pool)
+    def render(self, request):
+        name = (request.args.get('game') or request.args.get('name') or [''])[0]
+        port = self.ports[ris.shard_of(name, len(self.ports))]
+        headers = request.requestHeaders.copy()
+        # Overwrite, not append, so clients can't claim to be local
+        headers.setRawHeaders('x-forwarded-for', [request.getClientIP()])
+        headers.setRawHeaders('host', ['127.0.0.1:%d' % (port,)])
+        headers.removeHeader('connection')
+        url = 'http://127.0.0.1:%d%s' % (port, request.uri)
+        d = self.agent.request(request.method, url, headers)
+        def respond(resp):
+            request.setResponseCode(resp.code, resp.phrase)
+            # resp.headers leaves out the ones about the connection
+            for k, v in resp.headers.getAllRawHeaders():
+                request.responseHeaders.setRawHeaders(k, v)
+            if resp.length is not client.UNKNOWN_LENGTH:
+                request.setHeader('content-length', str(resp.length))
+            finished = defer.Deferred()
+            relay = Relay(request, finished)
+            resp.deliverBody(relay)
+            if lost:
+                relay.transport.stopProducing()
+            else:
+                # e.g. an /events stream, which the worker would keep sending
+                gone.append(relay.transport.stopProducing)
+            return finished
+        def failed(f):
+            if not lost:
+                request.setResponseCode(http.BAD_GATEWAY)
+                request.write("Shard unavailable: %s\n" % (f.getErrorMessage(),))
+        def done(_):
+            if not lost:
+                request.finish()
+        def disconnected(f):
+            lost.append(True)
+            for stop in gone:
+                stop()
+        lost, gone = [], []
+        request.notifyFinish().addErrback(disconnected)
+        d.addCallback(respond)
+        d.addErrback(failed)
+        d.addCallback(done)
+        return server.NOT_DONE_YET
+
+class ShardRoot(resource.Resource):
+    def __init__(self, ports):
+        resource.Resource.__init__(self)
+        self.router = ShardRouter(ports)
+        index = ShardIndex(ports)
+        self.putChild('', index)
+        self.putChild('index.htm', index)
+        self.putChild('main.css', static.Data(common.main_css, 'text/css'))
+    def getChild(self, path, request):
+        return self.router
+
+class Worker(protocol.ProcessProtocol):
+    """A shard worker process, which is restarted if it dies."""
+    def __init__(self, argv):
+        self.argv = argv
+        self.stopping = False
+        self.transport = None
+    def start(self):
+        reactor.spawnProcess(self, self.argv[0], self.argv, env=os.environ,
+                             childFDs={0: 'w', 1: 1, 2: 2})
+    def stop(self):
+        self.stopping = True
+        if self.transport is not None:
+            try:
+                self.transport.signalProcess('TERM')
+            except error.ProcessExitedAlready:
+                pass
+    def processEnded(self, reason):
+        self.transport = None
+        if not self.stopping:
+            print "Shard worker %r died (%s), restarting" % (
+                    self.argv[1:], reason.getErrorMessage())
+            reactor.callLater(1, self.start)
 
 def parse_args():
-    x = optparse.OptionParser()
-    x.add_option('-p', '--port', type='int', help='TCP port number to serve',
-                 default=8080)
-    x.add_option('-f', '--strict', action='store_true')
+    x = common.option_parser()
+    x.add_option('--publish', metavar='DIR',
+                 help='Keep a read-only copy of every game in DIR, for mirrors')
+    x.add_option('--publish-interval', type='float', default=1,
+                 help='Seconds between publishing (or, with --mirror, looking '
+                 'for) changed games')
+    x.add_option('--mirror', metavar='DIR',
+                 help="Serve the games another server publishes in DIR, "
+                 "read-only")
+    x.add_option('-j', '--shards', type='int',
+                 help='Split the games between this many worker processes')
+    x.add_option('--shard-port', type='int',
+                 help='First of the ports the workers listen on (default: the one after --port)')
+    x.add_option('--shard', help=optparse.SUPPRESS_HELP) # I/N; set on workers
     opts, args = x.parse_args()
     if args:
         x.error("Unexpected positional arguments")
+    if opts.mirror and (opts.publish or opts.shards or opts.db):
+        x.error("--mirror can't be used with --publish, --shards or --db")
+    if opts.shard is not None:
+        try:
+            i, n = map(int, opts.shard.split('/'))
+        except ValueError:
+            x.error("--shard must be I/N")
+        if not 0 <= i < n:
+            x.error("--shard must be I/N, with 0 <= I < N")
+        opts.shard = (i, n)
     return opts
 
-def load_games(opts):
-    rv = {}
-    for fn in os.listdir('games'):
-        try:
-            path = os.path.join('games', fn)
-            rv[fn] = ris.Game.load(fn, open(path, 'r'))
-        except Exception as e:
-            if opts.strict:
-                raise
-            print "Failed to load %s (skipping): %r" % (fn, e)
-    return rv
+def main_front(opts):
+    base = opts.shard_port or opts.port + 1
+    ports = [base + i for i in range(opts.shards)]
+    script = os.path.abspath(__file__)
+    workers = []
+    for i, port in enumerate(ports):
+        argv = [sys.executable, script, '-p', str(port),
+                '--shard', '%d/%d' % (i, opts.shards),
+                '--snapshot-interval', str(opts.snapshot_interval),
+                '--idle', str(opts.idle),
+                '--flush-delay', str(opts.flush_delay),
+                '--flush-limit', str(opts.flush_limit),
+                '--io-threads', str(opts.io_threads),
+                '--gzip-after', str(opts.gzip_after),
+                '--rate', str(opts.rate), '--burst', str(opts.burst),
+                '--max-queue', str(opts.max_queue)]
+        if opts.max_loaded is not None:
+            argv += ['--max-loaded', str(opts.max_loaded)]
+        if opts.strict:
+            argv.append('--strict')
+        if opts.db:
+            argv += ['--db', os.path.abspath(opts.db)]
+        argv += ['--firsts', os.path.abspath(opts.firsts)]
+        if opts.publish:
+            argv += ['--publish', os.path.abspath(opts.publish),
+                     '--publish-interval', str(opts.publish_interval)]
+        workers.append(Worker(argv))
+    for w in workers:
+        w.start()
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  lambda: [w.stop() for w in workers])
+    ep = "tcp:%d"%(opts.port,)
+    site = server.Site(ShardRoot(ports))
+    endpoints.serverFromString(reactor, ep).listen(site)
+    reactor.run()
 
 def main(opts):
-    global games
-    games = load_games(opts)
-    ep = "tcp:%d"%(opts.port,)
+    global trust_proxy, publisher
+    if opts.shards:
+        return main_front(opts)
+    common.configure(opts)
+    common.load_games(opts, store=opts.mirror and
+                                  ris.SnapshotStore(opts.mirror),
+                      shard=opts.shard)
+    reactor.suggestThreadPoolSize(opts.io_threads)
+    def evict():
+        flusher.evict(common.games)
+        if common.limiter is not None:
+            common.limiter.prune()
+    def shutdown():
+        d = flusher.drain()
+        d.addCallback(lambda _: common.games.write_index())
+        if publisher is not None:
+            # Only once the saves are safe; then wait for the copies too
+            d.addCallback(lambda _: publisher.publish())
+            d.addCallback(lambda _: flusher.drain())
+        return d
+    task.LoopingCall(evict).start(60, now=False)
+    if opts.mirror:
+        for name in ('newgame', 'rmgame', 'lock', 'join', 'part', 'sync',
+                     'completed', 'batch', 'events'):
+            root.putChild(name, ReadOnly())
+        task.LoopingCall(common.games.refresh).start(opts.publish_interval,
+                                              now=False)
+    elif opts.publish:
+        publisher = Publisher(ris.SnapshotStore(opts.publish))
+        publisher.start()
+        task.LoopingCall(publisher.publish).start(opts.publish_interval,
+                                                  now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
+    if opts.shard is None:
+        ep = "tcp:%d"%(opts.port,)
+    else:
+        # Only the front process should talk to us
+        ep = "tcp:%d:interface=127.0.0.1"%(opts.port,)
+        trust_proxy = True
+        root.putChild('summaries', Summaries())
     endpoints.serverFromString(reactor, ep).listen(server.Site(root))
     reactor.run()
 
+def test():
+    """Checks the pages html() writes, without nevow, against what nevow
+    gave, and that the Publisher keeps up with a game; run with
+    python -c 'import web; web.test()'."""
+    global flusher
+    class Flusher(object):
+        # Writes at once, rather than in the thread pool
+        def submit(self, name, fn):
+            return defer.maybeDeferred(fn)
+    g = ris.Game('G<1>')
+    for p in ['Zo\xc3\xab', 'A&B', 'C"d']:
+        g.join(p)
+    g.sync('A&B', ris.Date(1, 5), kia=2)
+    g.complete('SoundBarrier', 'A&B', ris.Date(1, 3))
+    g.complete('SoundBarrier', 'Zo\xc3\xab', ris.Date(1, 4))
+    g.complete('Gone', 'C"d', ris.Date(1, 1))
+    g.sync('Zo\xc3\xab', ris.Date(1, 6))
+    # Leaves Gone with no firstdate
+    g.part('C"d')
+    saved = common.games, flusher
+    common.games = ris.GameTable()
+    common.games[g.name] = g
+    flusher = Flusher()
+    tmp = tempfile.mkdtemp(prefix='riswebtest')
+    try:
+        pages = [(Index(), {'_local': True}),
+                 (Game(), {'name': 'G<1>', '_local': True}),
+                 (Player(), {'game': 'G<1>', 'name': 'A&B'}),
+                 (Result(), {'game': 'G<1>', 'contract': 'SoundBarrier'})]
+        for page, args in pages:
+            name = page.__class__.__name__
+            got = ''.join(page.html(**args))
+            assert got == golden[name], (name, got)
+        store = ris.SnapshotStore(tmp)
+        publisher = Publisher(store)
+        publisher.publish()
+        # Again with nothing changed, and then with something
+        publisher.publish()
+        g.sync('A&B', ris.Date(1, 7))
+        publisher.publish()
+        assert store.names() == ['G<1>'], store.names()
+        assert store.restore('G<1>').seq == g.seq
+        del common.games['G<1>']
+        publisher.publish()
+        assert store.names() == [] and publisher.published == {}
+    finally:
+        common.games, flusher = saved
+        shutil.rmtree(tmp)
+    print "web.py: ok"
+
+# What the nevow content() these pages had flattened to, for test(); except
+# that Game now lists contracts nobody holds last, rather than first
+golden = {
+    'Index': (
+        '<h1>KSP Race Into Space server</h1><h2>Games in progress</h2>'
+        '<table><tr><th>Name</th><th>Players</th><th>Min. Date</th></tr>'
+        '<form action="/rmgame" method="GET"><tr><td>'
+        '<a href="/game?name=G%3C1%3E">G&lt;1&gt;</a></td><td>'
+        'A&amp;B, Zo\xc3\xab</td><td>y01d005</td><td>'
+        '<input name="game" type="hidden" value="G&lt;1&gt;" />'
+        '<input type="submit" value="End" /></td></tr></form>'
+        '<form action="/newgame" method="GET"><tr><td>'
+        '<input name="name" type="text" /></td><td colspan="2"></td><td>'
+        '<input type="submit" value="New" /></td></tr></form></table>'),
+    'Game': (
+        '<h1>Game: G&lt;1&gt;</h1><h2>Min. Date: y01d005</h2><h2>Players'
+        '</h2><form action="/lock" method="GET">'
+        '<input name="game" type="hidden" value="G&lt;1&gt;" />'
+        '<input type="submit" value="Lock" /></form><table><tr><th>Name'
+        "</th><th>Date</th><th>Cem'y</th><th /><th /></tr>"
+        '<form action="/part" method="GET"><tr><td>'
+        '<a href="/player?game=G%3C1%3E&amp;name=A%26B">A&amp;B</a></td>'
+        '<td>y01d005</td><td Class="num">2</td><td></td><td>'
+        '<input name="game" type="hidden" value="G&lt;1&gt;" />'
+        '<input name="name" type="hidden" value="A&amp;B" />'
+        '<input type="submit" value="Remove" /></td></tr></form>'
+        '<form action="/part" method="GET"><tr><td>'
+        '<a href="/player?game=G%3C1%3E&amp;name=Zo%C3%AB">Zo\xc3\xab</a>'
+        '</td><td>y01d006</td><td Class="num">0</td><td>Leader</td><td>'
+        '<input name="game" type="hidden" value="G&lt;1&gt;" />'
+        '<input name="name" type="hidden" value="Zo\xc3\xab" />'
+        '<input type="submit" value="Remove" /></td></tr></form>'
+        '<form action="/join" method="GET">'
+        '<input name="game" type="hidden" value="G&lt;1&gt;" /><tr><td>'
+        '<input name="name" type="text" /></td><td colspan="2"></td><td>'
+        '<input type="submit" value="New" /></td></tr></form></table><h2>'
+        'Contracts</h2><ul><li>'
+        '<a href="/result?game=G%3C1%3E&amp;contract=SoundBarrier">'
+        'SoundBarrier</a>: (Zo\xc3\xab, y01d004, first)</li><li>'
+        '<a href="/result?game=G%3C1%3E&amp;contract=Gone">Gone</a>: ()'
+        '</li></ul>'),
+    'Player': (
+        '<h1>Player: A&amp;B</h1><h2>Date: y01d005</h2><h2>'
+        '2 astronauts K.I.A.</h2><table><tr><th>Contract</th><th>Date'
+        '</th><th>Result</th></tr><tr><td>'
+        '<a href="/result?game=G%3C1%3E&amp;contract=SoundBarrier">'
+        'SoundBarrier</a></td><td>y01d005</td><td>not_first</td></tr>'
+        '</table>'),
+    'Result': (
+        '<h1>Contract: SoundBarrier</h1><h2>Firstdate: y01d004</h2><h2>'
+        'Results</h2><table><tr><th>Player</th><th>Date</th><th>Result'
+        '</th></tr><tr><td>'
+        '<a href="/player?game=G%3C1%3E&amp;name=Zo%C3%AB">Zo\xc3\xab</a>'
+        '</td><td>y01d004</td><td>first</td></tr><tr><td>'
+        '<a href="/player?game=G%3C1%3E&amp;name=A%26B">A&amp;B</a></td>'
+        '<td>y01d005</td><td>not_first</td></tr></table>'),
+}
+
 if __name__ == '__main__':
     main(parse_args())